@@ -1,16 +1,69 @@
 #!/usr/bin/env python
 
-import pygame
 import math
 import random
 
 import physics
 import entities
+import pathing
+import timers
+import vectorized
+
+# Steering runs for one bucket of entities per step, so with the game at
+# 50 steps a second each entity steers 10 times a second.
+STEERING_BUCKETS = 5
+
+# Groups smaller than this are cheaper to steer one entity at a time than
+# to gather into arrays.
+BATCH_SIZE = 8
+
+# Directions shots leave in, for the attacks that fire in a pattern.
+WIDE_SPREAD = [physics.Polar(16, i / 4.0 * math.pi).to_cartesian() for i in range(8)]
+SWARM_SPREAD = [physics.Polar(16, i * math.pi).to_cartesian() for i in range(2)]
+
+# Timer kinds. JaggedPath and BulldozePath entities start moving halfway
+# through their movement timer and stop when it runs out.
+START_MOVING, STOP_MOVING, SHOOT = range(3)
+
+MOVEMENT_TIMERS = (entities.JaggedPath, entities.BulldozePath)
+# Attacks share one timer; when it runs out, the first of these that an
+# entity has fires.
+SHOOTING_TIMERS = (entities.ShootingAttack, entities.WideShootingAttack, entities.SwarmingAttack)
+
+def get_deadline(e, kind):
+    if kind == START_MOVING:
+        return e.last_movement_time + e.move_timer_delta / 2
+    if kind == STOP_MOVING:
+        return e.last_movement_time + e.move_timer_delta
+    return e.last_shoot_time + e.shoot_timer_delta
 
 class AI(object):
-    def __init__(self, timer):
+    '''
+    Only entities with a movement or attack component get any attention;
+    the rest, like bullets, are never looked at. Steering (TrackingPath
+    and CirclePath) is spread across `buckets` steps, so its cost per step
+    stays a fraction of the enemy count. Movement and shooting timers go
+    in a TimerQueue, so only the timers that run out cost anything.
+    Chasers find their way round steel rocks with a shared FlowField.
+    
+    Given the physics engine's KinematicsStore, big buckets are steered in
+    one numpy pass over the store's arrays instead of one entity at a time.
+    
+    The `last_*_time` and `*_timer_delta` attributes stay the record of
+    each timer. Anything that changes them from outside, like restoring a
+    snapshot, should call `reschedule` afterwards.
+    '''
+    def __init__(self, timer, buckets=STEERING_BUCKETS, store=None):
         self.timer = timer
+        self.store = store
         self.avoid = []
+        self.bullets = entities.Pool(entities.make_bullet, entities.reset_bullet)
+        self.stars = entities.Pool(entities.make_star, entities.reset_star)
+        self.buckets = buckets
+        self.bucket = 0
+        self.next_bucket = 0
+        self.timers = timers.TimerQueue()
+        self.field = pathing.FlowField()
         
     def initialize(self, things):
         for e in things:
@@ -18,96 +71,168 @@ class AI(object):
                 self.avoid.append(e)
         for e in things:
             if entities.JaggedPath in e:
-                e.last_movement_time = pygame.time.get_ticks()
+                e.last_movement_time = self.timer.get_ticks()
                 e.move_timer_delta = 10000 # milliseconds
                 e.speed = random.choice([14, 15, 16])
             if entities.TrackingPath in e:
                 e.speed = random.choice([3, 4, 5])
             if entities.BulldozePath in e:
-                e.last_movement_time = pygame.time.get_ticks()
+                e.last_movement_time = self.timer.get_ticks()
                 e.move_timer_delta = random.choice([4500, 5000, 5500])
                 e.speed = random.choice([14, 15, 16])
+            if entities.TrackingPath in e or entities.CirclePath in e:
+                e.ai_bucket = self.next_bucket
+                self.next_bucket = (self.next_bucket + 1) % self.buckets
                 
             if entities.ContactAttack in e:
                 e.additional_damage = random.choice(range(5, 15))
             if entities.ShootingAttack in e:
-                e.last_shoot_time = pygame.time.get_ticks()
+                e.last_shoot_time = self.timer.get_ticks()
                 e.shoot_timer_delta = 1000
             if entities.WideShootingAttack in e:
-                e.last_shoot_time = pygame.time.get_ticks()
+                e.last_shoot_time = self.timer.get_ticks()
                 e.shoot_timer_delta = 1000
             if entities.SwarmingAttack in e:
-                e.last_shoot_time = pygame.time.get_ticks()
+                e.last_shoot_time = self.timer.get_ticks()
                 e.shoot_timer_delta = 6000
             if entities.ExplodingAttack in e:
                 pass
                 
-            
+            self.schedule(e)
+                
+    def schedule(self, e, kinds=(START_MOVING, STOP_MOVING, SHOOT)):
+        if entities.AI not in e:
+            return
+        for kind in kinds:
+            if kind == SHOOT:
+                components = SHOOTING_TIMERS
+            else:
+                components = MOVEMENT_TIMERS
+            if any(component in e for component in components):
+                self.timers.add(get_deadline(e, kind), e, kind)
+                
+    def reschedule(self, things):
+        '''
+        Rebuilds every timer from the attributes of `things`. Does the same
+        as calling `schedule` for each of them, with mask tests in place of
+        component lookups, since it runs after every snapshot restore.
+        '''
+        self.field.reset()
+        movement = entities.get_mask(*MOVEMENT_TIMERS)
+        shooting = entities.get_mask(*SHOOTING_TIMERS)
+        found = []
+        for e in entities.query(things, entities.AI):
+            if e.mask & movement:
+                found.append((e.last_movement_time + e.move_timer_delta / 2, e, START_MOVING))
+                found.append((e.last_movement_time + e.move_timer_delta, e, STOP_MOVING))
+            if e.mask & shooting:
+                found.append((e.last_shoot_time + e.shoot_timer_delta, e, SHOOT))
+        self.timers.fill(found)
+                
+    def get_target(self):
+        if len(self.avoid) == 1:
+            return self.avoid[0]
+        return random.choice(self.avoid)
         
     def process(self, things):
-        time = pygame.time.get_ticks()
+        time = self.timer.get_ticks()
         new = []
-        for e in things:
-            if entities.AI not in e:
-                continue
+        
+        steering = self.bucket
+        self.bucket = (self.bucket + 1) % self.buckets
+        self.field.update(things, self.avoid, time)
+        
+        for deadline, e, kind in self.timers.pop_due(time):
+            if get_deadline(e, kind) > time:
+                # Moved since it was added.
+                self.schedule(e, [kind])
+            elif kind == START_MOVING:
+                self.start_moving(e)
+            elif kind == STOP_MOVING:
+                e.last_movement_time = time
+                e.velocity = physics.Cartesian(0, 0)
+                self.schedule(e, [START_MOVING, STOP_MOVING])
+            else:
+                e.last_shoot_time = time
+                self.shoot(e, new)
+                self.schedule(e, [SHOOT])
+                
+        tracking = [e for e in entities.query(things, entities.AI, entities.TrackingPath)
+                    if e.ai_bucket == steering]
+        circling = [e for e in entities.query(things, entities.AI, entities.CirclePath)
+                    if e.ai_bucket == steering]
+        # The batched versions draw targets and directions in the same
+        # order as track() and circle() and give the same numbers, so a
+        # seeded game plays out the same either way.
+        if self.store is None or len(tracking) < BATCH_SIZE:
+            for e in tracking:
+                self.track(e)
+        else:
+            targets = [self.get_target() for e in tracking]
+            vectorized.seek(self.store, tracking, targets, self.field)
             
-            if entities.JaggedPath in e:
-                if (time - e.last_movement_time) >= e.move_timer_delta / 2:
-                    if e.velocity.magnitude() == 0:
-                        e.velocity = physics.Polar(e.speed, random.random() * math.pi * 2).to_cartesian()
-                if (time - e.last_movement_time) >= e.move_timer_delta:
-                    e.last_movement_time = time
-                    e.velocity = physics.Cartesian(0, 0)
-            if entities.TrackingPath in e:
-                target = random.choice(self.avoid)
-                vector = (target.position - e.position).to_polar()
-                vector.magnitude = e.speed
-                e.velocity = vector.to_cartesian()
-            if entities.BulldozePath in e:
-                if (time - e.last_movement_time) >= e.move_timer_delta / 2:
-                    if e.velocity.magnitude() == 0:
-                        target = random.choice(self.avoid)
-                        vector = (target.position - e.position).to_polar()
-                        vector.magnitude = e.speed
-                        e.velocity = vector.to_cartesian()
-                if (time - e.last_movement_time) >= e.move_timer_delta:
-                    e.last_movement_time = time
-                    e.velocity = physics.Cartesian(0, 0)
-            if entities.CirclePath in e:
-                human = random.choice(self.avoid)
-                distance = physics.get_distance(e.position, human.position)
-                normal = physics.calculate_normal(human.position, e.position)
-                        
-                if distance > human.draw_radius + 200:
-                    e.position = human.position - (human.draw_radius + 175) * normal
-                            
-                if distance < human.draw_radius + 150:
-                    e.position = human.position - (human.push_radius + 175) * normal
+        if self.store is None or len(circling) < BATCH_SIZE:
+            for e in circling:
+                self.circle(e)
+        else:
+            humans = []
+            signs = []
+            for e in circling:
+                humans.append(self.get_target())
+                signs.append(random.choice([1, -1]))
+            vectorized.orbit(self.store, circling, humans, signs, self.buckets)
+                    
+        return new
+        
+    def head_for(self, e, target):
+        '''Which way `e` should set off to get to `target`, as a unit vector.'''
+        detour = self.field.sample(e.position)
+        if detour is None:
+            return (target.position - e.position).normalize()
+        return physics.Cartesian(*detour)
+        
+    def track(self, e):
+        target = self.get_target()
+        e.velocity = self.head_for(e, target).imul(e.speed)
+        
+    def circle(self, e):
+        human = self.get_target()
+        distance = physics.get_distance(e.position, human.position)
+        normal = physics.calculate_normal(human.position, e.position)
                 
-                normal = normal.to_polar()
-                normal.magnitude = e.mass * human.mass / distance**2
-                normal.angle += random.choice([math.pi / 2, -math.pi / 2])
-                e.velocity += normal.to_cartesian()
-                        
-                        
-            if entities.ShootingAttack in e:
-                if (time - e.last_shoot_time)  >= e.shoot_timer_delta:
-                    e.last_shoot_time = time
-                    bullet = entities.make_bullet(e.position, random.choice(self.avoid).position, e.radius)
-                    new.append(bullet)
-            if entities.WideShootingAttack in e:
-                if (time - e.last_shoot_time)  >= e.shoot_timer_delta:
-                    e.last_shoot_time = time
-                    for i in range(8):
-                        target = e.position + physics.Polar(16, i / 4.0 * math.pi).to_cartesian()
-                        bullet = entities.make_bullet(e.position, target, e.radius)
-                        new.append(bullet)
-            if entities.SwarmingAttack in e:
-                if (time - e.last_shoot_time)  >= e.shoot_timer_delta:
-                    e.last_shoot_time = time
-                    for i in range(2):
-                        target = e.position + physics.Polar(16, i * math.pi).to_cartesian()
-                        star = entities.make_star(e.position, target, e.radius)
-                        new.append(star)
+        if distance > human.draw_radius + 200:
+            e.position = human.position - (human.draw_radius + 175) * normal
+                    
+        if distance < human.draw_radius + 150:
+            e.position = human.position - (human.push_radius + 175) * normal
+        
+        # Quarter turn either way, without going through Polar. The push
+        # is scaled up to make up for the steps this entity sits out.
+        tangent = physics.Cartesian(-normal.y, normal.x)
+        tangent *= random.choice([1, -1]) * e.mass * human.mass / distance**2 * self.buckets
+        e.velocity += tangent
+        
+    def start_moving(self, e):
+        if e.velocity.length_squared() != 0:
+            return
+        if entities.JaggedPath in e:
+            e.velocity = physics.Polar(e.speed, random.random() * math.pi * 2).to_cartesian()
+        else:
+            target = self.get_target()
+            e.velocity = self.head_for(e, target).imul(e.speed)
             
-        return new
\ No newline at end of file
+    def shoot(self, e, new):
+        if entities.ShootingAttack in e:
+            bullet = self.bullets.acquire(e.position, self.get_target().position, e.radius)
+            bullet.source = e
+            new.append(bullet)
+        elif entities.WideShootingAttack in e:
+            for direction in WIDE_SPREAD:
+                bullet = self.bullets.acquire(e.position, e.position + direction, e.radius)
+                bullet.source = e
+                new.append(bullet)
+        else:
+            for direction in SWARM_SPREAD:
+                star = self.stars.acquire(e.position, e.position + direction, e.radius)
+                star.source = e
+                new.append(star)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+'''
+Plays lots of headless games in parallel and reports how the waves are
+balanced: how far players get, what they score, and which kinds of enemy
+do the damage. Every game has its own seed, so any game in a report can
+be played again on its own.
+
+    python balance.py --games 200 --player bot --output balance.json
+'''
+
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import timeit
+
+import entities
+import headless
+import profiling
+
+MOVEMENTS = (
+    entities.JaggedPath,
+    entities.TrackingPath,
+    entities.BulldozePath,
+    entities.CirclePath,
+)
+
+ATTACKS = (
+    entities.ShootingAttack,
+    entities.WideShootingAttack,
+    entities.ContactAttack,
+    entities.SwarmingAttack,
+    entities.ExplodingAttack,
+)
+
+
+def is_shot(e):
+    return entities.Bullet in e or entities.Star in e
+
+
+def get_archetype(e):
+    '''
+    A name for what kind of thing `e` is, as far as balance goes. Shots
+    count as whatever fired them, so that an archetype's damage includes
+    its shots.
+    '''
+    for shot in (entities.Bullet, entities.Star):
+        if shot in e:
+            if not hasattr(e, 'source'):
+                return shot
+            return get_archetype(e.source)
+    if entities.Rock in e:
+        return 'Rock'
+    return ' + '.join(c for c in MOVEMENTS + ATTACKS if c in e)
+
+
+class DamageLog(headless.NullRenderer):
+    '''
+    A NullRenderer that counts the enemies each wave brings, and the
+    damage players take from each kind of thing they collide with or are
+    shot by. `shot_damage` is the part of `damage` that came from shots.
+    '''
+    def __init__(self):
+        headless.NullRenderer.__init__(self)
+        self.seen = collections.Counter()
+        self.hits = collections.Counter()
+        self.damage = collections.Counter()
+        self.shot_damage = collections.Counter()
+
+    def initialize(self, things):
+        headless.NullRenderer.initialize(self, things)
+        for e in things:
+            if entities.Enemy in e and not is_shot(e):
+                self.seen[get_archetype(e)] += 1
+
+    def process(self, things, collisions=()):
+        for first, second, point, reason, impulse, damage_first, damage_second in collisions:
+            if entities.UserControllable in first:
+                self.log(second, damage_first)
+            if entities.UserControllable in second:
+                self.log(first, damage_second)
+
+    def log(self, source, damage):
+        archetype = get_archetype(source)
+        self.hits[archetype] += 1
+        self.damage[archetype] += damage
+        if is_shot(source):
+            self.shot_damage[archetype] += damage
+
+
+class BotEvents(headless.ScriptedEvents):
+    '''
+    A player that plays by itself: it keeps the collector on and chases
+    the nearest enemy so that whatever it holds smashes into it, letting
+    go every `fling_every` frames.
+    '''
+    def __init__(self, fling_every=150):
+        headless.ScriptedEvents.__init__(self)
+        self.fling_every = fling_every
+        self.frame = 0
+
+    def process(self, things):
+        self.frame += 1
+        mouse = self.mouse
+        humans = entities.query(things, entities.UserControllable)
+        enemies = [e for e in entities.query(things, entities.Enemy) if entities.Bullet not in e]
+        if len(humans) > 0 and len(enemies) > 0:
+            human = humans[0]
+            target = min(enemies, key=lambda e: (e.position - human.position).length_squared())
+            mouse = (int(target.position.x), int(target.position.y))
+        held = self.frame % self.fling_every != 0
+        self.control(things, mouse, held and not self.held, self.held and not held)
+        self.mouse = mouse
+        self.held = held
+
+
+def make_script(frames, period=400):
+    '''Circles the middle of the screen, holding for half of each lap.'''
+    script = []
+    for i in xrange(frames):
+        angle = 2 * math.pi * i / period
+        script.append((
+            int(400 + 250 * math.cos(angle)),
+            int(400 + 250 * math.sin(angle)),
+            i % period < period / 2))
+    return script
+
+PLAYERS = collections.OrderedDict([
+    ('bot', lambda frames: BotEvents()),
+    ('script', lambda frames: headless.ScriptedEvents(make_script(frames))),
+])
+
+
+def play_game(job):
+    '''
+    Plays waves until the player loses or `max_waves` are won. Runs in a
+    worker process, so everything it needs comes in `job` and everything
+    it finds goes back in the returned dict.
+    '''
+    seed, player, max_waves, max_frames = job
+    random.seed(seed)
+    log = DamageLog()
+    start = timeit.default_timer()
+
+    waves = []
+    score = 0
+    for wave in xrange(max_waves):
+        result = headless.run_wave(
+            score, max_frames=max_frames, events=PLAYERS[player](max_frames), renderer=log)
+        waves.append(result)
+        if result['outcome'] != 'won':
+            break
+        score = result['max_score']
+
+    return {
+        'seed': seed,
+        'worker': os.getpid(),
+        'seconds': timeit.default_timer() - start,
+        'waves': waves,
+        'seen': dict(log.seen),
+        'hits': dict(log.hits),
+        'damage': dict(log.damage),
+        'shot_damage': dict(log.shot_damage),
+    }
+
+
+def summarize(values):
+    if len(values) == 0:
+        return None
+    return collections.OrderedDict([
+        ('mean', sum(values) / float(len(values))),
+        ('p10', profiling.percentile(values, 0.10)),
+        ('p50', profiling.percentile(values, 0.50)),
+        ('p90', profiling.percentile(values, 0.90)),
+    ])
+
+
+def make_report(games, seconds):
+    waves = collections.OrderedDict()
+    for game in games:
+        for number, wave in enumerate(game['waves'], 1):
+            stats = waves.setdefault(number, {'played': 0, 'won': 0, 'frames': [], 'max_score': []})
+            stats['played'] += 1
+            stats['won'] += wave['outcome'] == 'won'
+            stats['frames'].append(wave['frames'])
+            stats['max_score'].append(wave['max_score'])
+
+    seen = collections.Counter()
+    hits = collections.Counter()
+    damage = collections.Counter()
+    shot_damage = collections.Counter()
+    workers = collections.defaultdict(lambda: {'games': 0, 'frames': 0, 'seconds': 0.0})
+    for game in games:
+        seen.update(game['seen'])
+        hits.update(game['hits'])
+        damage.update(game['damage'])
+        shot_damage.update(game['shot_damage'])
+        worker = workers[game['worker']]
+        worker['games'] += 1
+        worker['frames'] += sum(wave['frames'] for wave in game['waves'])
+        worker['seconds'] += game['seconds']
+
+    return collections.OrderedDict([
+        ('games', len(games)),
+        ('seconds', seconds),
+        ('games_per_second', len(games) / seconds if seconds > 0 else None),
+        ('waves_reached', summarize([len(game['waves']) for game in games])),
+        ('survival_seconds', summarize(
+            [sum(wave['time'] for wave in game['waves']) / 1000.0 for game in games])),
+        ('score', summarize([game['waves'][-1]['score'] for game in games])),
+        ('waves', [collections.OrderedDict([
+            ('wave', number),
+            ('played', stats['played']),
+            ('win_rate', stats['won'] / float(stats['played'])),
+            ('frames', summarize(stats['frames'])),
+            ('max_score', summarize(stats['max_score'])),
+        ]) for number, stats in waves.items()]),
+        ('damage_taken', collections.OrderedDict(
+            (archetype, collections.OrderedDict([
+                ('seen', seen[archetype]),
+                ('hits', hits[archetype]),
+                ('damage', total),
+                ('shot_damage', shot_damage[archetype]),
+                ('damage_per_enemy', total / seen[archetype] if seen[archetype] > 0 else None),
+            ])) for archetype, total in damage.most_common())),
+        ('workers', [collections.OrderedDict([
+            ('pid', pid),
+            ('games', worker['games']),
+            ('fps', worker['frames'] / worker['seconds'] if worker['seconds'] > 0 else None),
+        ]) for pid, worker in sorted(workers.items())]),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Orbital Smash wave balancing')
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--player', default='bot', choices=list(PLAYERS.keys()))
+    parser.add_argument('--max-waves', type=int, default=10)
+    parser.add_argument('--max-frames', type=int, default=15000,
+                        help='give up on a wave after this many frames')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first game')
+    parser.add_argument('--output', default=None, help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    jobs = [(args.seed + i, args.player, args.max_waves, args.max_frames) for i in xrange(args.games)]
+    start = timeit.default_timer()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        games = []
+        for game in pool.imap_unordered(play_game, jobs):
+            games.append(game)
+            sys.stderr.write('\r{0}/{1} games'.format(len(games), len(jobs)))
+        sys.stderr.write('\n')
+    finally:
+        pool.close()
+        pool.join()
+    games.sort(key=lambda game: game['seed'])
+
+    text = json.dumps(make_report(games, timeit.default_timer() - start), indent=2)
+    if args.output is None:
+        print text
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+'''
+Measures how the per-frame cost of each processor scales with the number
+of entities. Results are printed (or written) as JSON so runs from
+different revisions can be diffed.
+
+    python benchmark.py --sizes 10 100 1000 --frames 50 --output bench.json
+'''
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import sys
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import ai
+import entities
+import frames
+import graphics
+import headless
+import physics
+import vectorized
+
+
+def make_rocks(n):
+    return [entities.make_human()] + [entities.make_rock() for i in xrange(n)]
+
+def make_wide_shooters(n):
+    things = [entities.make_human()]
+    for i in xrange(n):
+        e = entities.make_shooter()
+        e.remove(entities.ShootingAttack)
+        e.add(entities.WideShootingAttack)
+        things.append(e)
+    return things
+
+def make_collector(n):
+    return make_rocks(n)
+
+SCENARIOS = collections.OrderedDict([
+    ('rocks', make_rocks),
+    ('wide_shooters', make_wide_shooters),
+    ('collector', make_collector),
+])
+
+
+def get_memory():
+    '''
+    Peak resident set size of this process in kilobytes, where the
+    platform reports it. It never goes down, so each run gets a process
+    of its own (see measure).
+    '''
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        usage /= 1024
+    return usage
+
+
+def run(scenario, n, frame_count, renderer):
+    random.seed(n)
+    things = entities.World(SCENARIOS[scenario](n))
+
+    clock = headless.VirtualClock()
+    store = vectorized.make_store()
+    brain = ai.AI(clock, store=store)
+    events = headless.ScriptedEvents()
+    engine = physics.Physics(0.02, graphics.MAX_RADIUS, store)
+    processors = [brain, events, engine, renderer]
+    simulators = [brain, engine]
+
+    for p in processors:
+        p.initialize(things)
+    if scenario == 'collector':
+        human = things[0]
+        human.is_collector_active = True
+        human.collected_objects = [things[1].handle()]
+
+    timings = collections.OrderedDict([('ai', 0.0), ('physics', 0.0), ('render', 0.0)])
+    counts = []
+    for frame in xrange(frame_count):
+        clock.advance(20)
+        counts.append(len(things))
+        events.process(things)
+        engine.collisions.clear()
+
+        start = timeit.default_timer()
+        frames.add_spawned(things, brain.process(things), processors, simulators)
+        timings['ai'] += timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        engine.process(things)
+        timings['physics'] += timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        renderer.process(things, engine.collisions)
+        renderer.display()
+        timings['render'] += timeit.default_timer() - start
+
+        frames.flush_dead(things)
+
+    total = sum(timings.values())
+    return collections.OrderedDict([
+        ('scenario', scenario),
+        ('n', n),
+        ('frames', frame_count),
+        ('ns_per_frame', collections.OrderedDict(
+            (name, int(seconds * 1e9 / frame_count)) for name, seconds in timings.items())),
+        ('entities_per_second', sum(counts) / total if total > 0 else None),
+        ('mean_entities', sum(counts) / float(frame_count)),
+        ('max_rss_kb', get_memory()),
+    ])
+
+
+def measure(job):
+    '''
+    Does one run in a fresh worker process, so that its max_rss_kb is not
+    the peak of whichever bigger run came before it.
+    '''
+    scenario, n, frame_count, render, vectorize = job
+    vectorized.enabled = vectorize
+    if render:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        renderer = graphics.Renderer()
+    else:
+        renderer = headless.NullRenderer()
+    return run(scenario, n, frame_count, renderer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Orbital Smash benchmarks')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS.keys()),
+                        choices=list(SCENARIOS.keys()))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 5000])
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--render', action='store_true',
+                        help='time the real pygame renderer (uses a dummy video driver)')
+    parser.add_argument('--vectorize', action='store_true',
+                        help='integrate with the numpy kinematics store')
+    parser.add_argument('--label', default=None, help='free-form revision label')
+    parser.add_argument('--output', default=None, help='write JSON here instead of stdout')
+    args = parser.parse_args()
+    vectorized.enabled = args.vectorize
+
+    results = collections.OrderedDict([
+        ('label', args.label),
+        ('render', args.render),
+        ('vectorized', vectorized.make_store() is not None),
+        ('results', []),
+    ])
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for scenario in args.scenarios:
+            for n in args.sizes:
+                job = (scenario, n, args.frames, args.render, args.vectorize)
+                result = pool.apply(measure, (job,))
+                results['results'].append(result)
+                sys.stderr.write('{0} n={1}: {2}\n'.format(
+                    scenario, n, dict(result['ns_per_frame'])))
+    finally:
+        pool.close()
+        pool.join()
+
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        print text
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
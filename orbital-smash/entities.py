@@ -1,25 +1,165 @@
 #!/usr/bin/env python
 
-import copy
+import collections
 import random
 
+# Every component gets its own bit the first time it is seen, so an entity's
+# components can be checked with a single mask test.
+component_bits = {}
+
+def get_bit(component):
+    bit = component_bits.get(component)
+    if bit is None:
+        bit = component_bits[component] = 1 << len(component_bits)
+    return bit
+    
+def get_mask(*components):
+    mask = 0
+    for component in components:
+        mask |= get_bit(component)
+    return mask
+    
+def query(things, *components):
+    '''
+    Entities in `things` that have all of `components`. Worlds answer from
+    their index; plain lists are filtered.
+    '''
+    if isinstance(things, World):
+        return things.query(*components)
+    mask = get_mask(*components)
+    return [e for e in things if e.mask & mask == mask]
+    
+def resolve(handle):
+    '''
+    The entity a handle refers to, or None if that entity has since left
+    its world (and possibly been reused).
+    '''
+    e, generation = handle
+    if e.world is None or e.generation != generation:
+        return None
+    return e
+
 class Entity(object):
     def __init__(self, *components):
         self.components = list(components)
+        self.mask = get_mask(*components)
+        self.world = None
+        # Bumped every time the entity leaves a world, which invalidates
+        # any handle taken before then.
+        self.generation = 0
         
     def __contains__(self, value):
-        return value in self.components
+        return self.mask & component_bits.get(value, 0) != 0
         
     def remove(self, value):
-        if value in self.components:
+        if value in self:
             del self.components[self.components.index(value)]
+            self.mask &= ~component_bits[value]
+            if self.world is not None:
+                self.world.unindex(self, value)
             
     def add(self, value):
-        if value not in self.components:
+        if value not in self:
             self.components.append(value)
+            self.mask |= get_bit(value)
+            if self.world is not None:
+                self.world.reindex(self, value)
+            
+    def handle(self):
+        return (self, self.generation)
             
     def copy(self):
-        return copy.deepcopy(self)
+        '''
+        A detached copy. Vectors and lists are copied; sprites and anything
+        else are shared with this entity. Use the snapshot module to copy
+        a whole world.
+        '''
+        other = Entity(*self.components)
+        for name, value in self.__dict__.items():
+            if name in other.__dict__ or name in ('world_index', 'row', 'pool', 'in_pool'):
+                continue
+            if hasattr(value, 'x'):
+                value = value.copy()
+            elif isinstance(value, list):
+                value = list(value)
+            setattr(other, name, value)
+        return other
+            
+class World(object):
+    '''
+    The live entities of a game, plus for every component the entities that
+    have it. The per-component sets keep insertion order, so queries are
+    deterministic.
+    
+    Entities are stored densely and removed by swapping the last one into
+    the hole, so removal is O(1) but does not preserve the order of a plain
+    scan. Entities that gain the Dead component are queued for removal;
+    nothing leaves the world until `flush` is called.
+    '''
+    def __init__(self, things=()):
+        self.things = []
+        self.index = {}
+        self.pending = []
+        self.extend(things)
+        
+    def __iter__(self):
+        return iter(self.things)
+        
+    def __len__(self):
+        return len(self.things)
+        
+    def __getitem__(self, index):
+        return self.things[index]
+        
+    def append(self, e):
+        e.world = self
+        e.world_index = len(self.things)
+        self.things.append(e)
+        for component in e.components:
+            self.reindex(e, component)
+            
+    def extend(self, things):
+        for e in things:
+            self.append(e)
+            
+    def remove(self, e):
+        last = self.things.pop()
+        if last is not e:
+            self.things[e.world_index] = last
+            last.world_index = e.world_index
+        for component in e.components:
+            self.unindex(e, component)
+        e.world = None
+        e.generation += 1
+        
+    def despawn(self, e):
+        self.pending.append(e)
+        
+    def flush(self):
+        '''Removes everything queued for despawn and returns it.'''
+        gone = []
+        for e in self.pending:
+            if e.world is self:
+                self.remove(e)
+                gone.append(e)
+        self.pending = []
+        return gone
+        
+    def reindex(self, e, component):
+        if component not in self.index:
+            self.index[component] = collections.OrderedDict()
+        self.index[component][e] = None
+        if component == Dead:
+            self.despawn(e)
+        
+    def unindex(self, e, component):
+        del self.index[component][e]
+        
+    def query(self, *components):
+        found = [self.index.get(component, ()) for component in components]
+        smallest = min(found, key=len)
+        mask = get_mask(*components)
+        return [e for e in smallest if e.mask & mask == mask]
     
 UserControllable = "UserControllable"
 
@@ -53,7 +193,6 @@ Damageable = "Damageable"
 Rotates = "Rotates"
 FacesUser = "FacesUser"
 Dead = "Dead"
-Explosion = "Explosion"
 AI = "AI"
 
 # Attack patterns
@@ -174,13 +313,10 @@ def make_enemy():
         
         
     
-def make_explosion(position, reason):
-    e = Entity(
-        Explosion,
-    )
-    e.position = position
-    e.reason = reason
-    return e
+def aim(e, start, target, radius):
+    normal = (target - start).normalize()
+    e.initial_velocity = normal * 8
+    e.initial_position = start + normal * (radius + 25)
     
 def make_bullet(start, target, radius):
     bullet = Entity(
@@ -195,20 +331,22 @@ def make_bullet(start, target, radius):
         ContactAttack, 
         RemoveWhenUnbounded
     )
-    
-    vector = target - start
-
-    vector = vector.to_polar()
-    normal = vector.copy()
-    
-    vector.magnitude = 8
-    normal.magnitude = (radius + 25)
-    
-    bullet.initial_velocity = vector.to_cartesian()
-    bullet.initial_position = start + normal.to_cartesian()
+    aim(bullet, start, target, radius)
     bullet.additional_damage = 50
     return bullet
     
+def reset_bullet(bullet, start, target, radius):
+    bullet.remove(Dead)
+    aim(bullet, start, target, radius)
+    bullet.additional_damage = 50
+    
+star_movements = [
+    JaggedPath,
+    TrackingPath,
+    BulldozePath,
+    CirclePath
+]
+    
 def make_star(start, target, radius):
     star = Entity(
         AI, 
@@ -223,24 +361,54 @@ def make_star(start, target, radius):
         Rotates,
         FacesUser,
         Bounded,
-        random.choice([
-            JaggedPath,
-            TrackingPath,
-            BulldozePath,
-            CirclePath
-        ])
+        random.choice(star_movements)
     )
+    aim(star, start, target, radius)
+    return star
     
-    vector = target - start
-
-    vector = vector.to_polar()
-    normal = vector.copy()
+def reset_star(star, start, target, radius):
+    star.remove(Dead)
+    for movement in star_movements:
+        star.remove(movement)
+    star.add(random.choice(star_movements))
+    aim(star, start, target, radius)
     
-    vector.magnitude = 8
-    normal.magnitude = (radius + 25)
     
-    star.initial_velocity = vector.to_cartesian()
-    star.initial_position = start + normal.to_cartesian()
-    return star
+class Pool(object):
+    '''
+    Hands out entities built by `factory`, reusing despawned ones where it
+    can. `reset` re-arms a reused entity in place and takes the same
+    arguments as the factory. Reused entities come back with `recycled`
+    set, so the game loop knows they only need the per-spawn part of
+    initialization.
     
-    
\ No newline at end of file
+    `reclaim` takes an entity back out of the pool without resetting it,
+    for when a snapshot brings it back to life.
+    '''
+    def __init__(self, factory, reset):
+        self.factory = factory
+        self.reset = reset
+        self.free = []
+        
+    def acquire(self, *args):
+        while len(self.free) > 0:
+            e = self.free.pop()
+            if e.in_pool:
+                e.in_pool = False
+                self.reset(e, *args)
+                e.recycled = True
+                return e
+        e = self.factory(*args)
+        e.pool = self
+        e.in_pool = False
+        e.recycled = False
+        return e
+        
+    def release(self, e):
+        if not e.in_pool:
+            e.in_pool = True
+            self.free.append(e)
+            
+    def reclaim(self, e):
+        # Left in `free` and skipped by acquire, so this stays O(1).
+        e.in_pool = False
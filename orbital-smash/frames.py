@@ -3,6 +3,7 @@
 import pygame
 import collections
 import math
+import os.path
 import random
 
 import entities
@@ -10,6 +11,10 @@ import ai
 import ui
 import physics
 import graphics
+import savestate
+import vectorized
+
+SAVE_PATH = 'save.dat'
 
 class EndFrame(Exception): pass
 
@@ -27,29 +32,95 @@ def end_game():
     pygame.quit()
     raise SystemExit(0)
     
+class Clock(object):
+    '''
+    `tick` limits the frame rate and reports the real milliseconds since the
+    last frame, like pygame's Clock. `get_ticks` is simulation time, which
+    only moves when the game loop advances it by a fixed step.
+    '''
+    def __init__(self):
+        self.clock = pygame.time.Clock()
+        self.time = 0
+        
+    def tick(self, fps):
+        return self.clock.tick(fps)
+        
+    def advance(self, milliseconds):
+        self.time += milliseconds
+        
+    def restart(self):
+        '''Forgets the real time spent since the last tick.'''
+        self.clock.tick()
+        
+    def get_ticks(self):
+        return self.time
+    
+def add_spawned(things, out, processors, simulators):
+    '''
+    Sets up the entities in `out` and adds them to `things`. New ones go
+    through all of `processors`. Pooled ones already have their sprite and
+    input state, so only the `simulators` (AI and physics) set them up
+    again.
+    '''
+    fresh = [e for e in out if not getattr(e, 'recycled', False)]
+    recycled = [e for e in out if getattr(e, 'recycled', False)]
+    for p in processors:
+        p.initialize(fresh)
+    for p in simulators:
+        p.initialize(recycled)
+    things.extend(out)
+    
+def flush_dead(things):
+    '''Despawns the dead from `things`, handing pooled ones back, and returns them.'''
+    gone = things.flush()
+    for e in gone:
+        if hasattr(e, 'pool'):
+            e.pool.release(e)
+    return gone
+    
 class Gameloop(object):
-    def __init__(self, renderer, things, prev_score):
+    def __init__(self, renderer, things, prev_score, timer=None, events=None, state=None):
     
-        self.timer = pygame.time.Clock()
+        self.timer = timer or Clock()
+        self.timer.restart()
         self.fps = 50.0
         
-        self.brain = ai.AI(self.timer)
-        self.events = ui.Events()
-        self.engine = physics.Physics(1 / self.fps)
-        self.renderer = renderer
+        # Simulation runs in fixed steps of 1/fps seconds no matter how fast
+        # frames are drawn; see loop().
+        self.step = 1000 / self.fps
+        self.max_substeps = 5
+        self.accumulator = self.step
         
-        human = entities.make_human()
+        # Set when the loop hands over to a menu, since the time spent
+        # there shouldn't be caught up on afterwards.
+        self.resuming = False
         
-        self.queue = []
-        
-        self.things = [human, entities.make_steel()]
+        # With vectorized.enabled, the AI steers straight in the arrays the
+        # physics engine integrates.
+        store = vectorized.make_store()
+        self.brain = ai.AI(self.timer, store=store)
+        self.events = events or ui.Events()
+        self.engine = physics.Physics(1 / self.fps, graphics.MAX_RADIUS, store)
+        self.renderer = renderer
+        self.profiler = renderer.profiler
         
-        floor = int(math.sqrt(prev_score / 100)) + 3
-        for i in xrange(floor):
-            if random.random() < 0.2 and i != 0:
-                self.queue.append(entities.make_rock())
-            else:
-                self.queue.append(entities.make_enemy())
+        if state is None:
+            human = entities.make_human()
+            
+            self.queue = []
+            
+            self.things = entities.World([human, entities.make_steel()])
+            
+            floor = int(math.sqrt(prev_score / 100)) + 3
+            for i in xrange(floor):
+                if random.random() < 0.2 and i != 0:
+                    self.queue.append(entities.make_rock())
+                else:
+                    self.queue.append(entities.make_enemy())
+        else:
+            # A suspended wave; see suspend().
+            self.things = entities.World(state.world.things)
+            self.queue = state.queue.things
         
         self.brain.initialize(self.things)
         self.events.initialize(self.things)
@@ -61,48 +132,99 @@ class Gameloop(object):
         self.engine.initialize(self.queue)
         self.renderer.initialize(self.queue)
         
-        self.max_score = prev_score + sum([e.max_health for e in self.queue if entities.Enemy in e])
+        if state is None:
+            self.max_score = prev_score + sum([e.max_health for e in self.queue if entities.Enemy in e])
+        else:
+            state.apply(self.things, self.timer)
+            self.brain.reschedule(list(self.things) + self.queue)
+            self.max_score = state.max_score
+            
+    def suspend(self, path):
+        '''Saves the wave in progress, so that resume() can carry on with it.'''
+        savestate.save(path, self.things, self.queue, self.max_score, self.timer)
     
-    def initialize(self, processors, things):
-        for p in processors:
-            p.initialize(things)
-        return things
+    def spawn(self, out):
+        add_spawned(
+            self.things, out,
+            [self.brain, self.events, self.engine, self.renderer],
+            [self.brain, self.engine])
+        self.profiler.spawned(len(out))
+        
+    def simulate(self):
+        self.timer.advance(self.step)
+        
+        self.spawn(self.brain.process(self.things))
+        self.profiler.mark('ai')
+        
+        self.engine.process(self.things)
+        self.profiler.mark('physics')
         
     def loop(self):
-        out = self.brain.process(self.things)
-        self.things.extend(self.initialize([self.brain, self.events, self.engine, self.renderer], out))
+        if self.resuming:
+            self.timer.restart()
+            self.resuming = False
+            
+        self.profiler.begin()
         
         next_frame = self.events.process(self.things)
         if next_frame is not None:
-            next_frame = next_frame(self.renderer, self.things)
-        out = self.engine.process(self.things)
-        self.things.extend(self.initialize([self.brain, self.events, self.engine, self.renderer], out))
+            next_frame = next_frame(self)
+        self.profiler.mark('events')
+        
+        self.engine.collisions.clear()
+            
+        # Catch the simulation up with real time. If that would take more
+        # than max_substeps, drop the backlog rather than let every later
+        # frame fall further behind.
+        steps = 0
+        while self.accumulator >= self.step and steps < self.max_substeps:
+            self.simulate()
+            self.accumulator -= self.step
+            steps += 1
+        self.accumulator = min(self.accumulator, self.step)
                 
-        self.renderer.process(self.things)
+        self.renderer.process(self.things, self.engine.collisions)
+        if self.profiler.enabled:
+            self.renderer.draw_profiler()
         self.renderer.display()
+        self.profiler.mark('render')
         
         size = random.choice([5, 6, 7, 9, 10, 11])
         if len(self.things) < size:
             while len(self.things) < size and len(self.queue) > 0:
                 self.things.append(self.queue.pop())
         
-        for e in self.things:
-            if entities.Dead in e or entities.Explosion in e:
-                del self.things[self.things.index(e)]
+        self.profiler.despawned(len(flush_dead(self.things)))
             
         
-        players_left = len([e for e in self.things if entities.UserControllable in e])
+        players_left = len(self.things.query(entities.UserControllable))
         if players_left == 0 and len(self.renderer.animations) == 0:
-            next_frame = make_game_over(self.renderer, self.things, self.max_score)
+            next_frame = make_game_over(self.renderer, self.things, self.max_score, self.timer, self.events)
             
-        enemies_left = len([e for e in self.things if entities.Enemy in e])
+        enemies_left = len(self.things.query(entities.Enemy))
         if enemies_left == 0:
-            make_continue_game(self.renderer, self.things, self.max_score)
+            make_continue_game(self.renderer, self.things, self.max_score, self.timer, self.events)
+            
+        self.profiler.mark('cleanup')
+        self.profiler.end(self.things)
                 
-        self.timer.tick(self.fps)
+        self.accumulator += self.timer.tick(self.fps)
         
+        self.resuming = next_frame is not None
         return next_frame
 
+def get_events(renderer, clock, redraw, fps=50.0):
+    '''
+    The events for the next frame of a menu or dialog, at no more than
+    `fps` frames a second. Unless `redraw` is set or an explosion is still
+    playing underneath, nothing on screen changes until the player does
+    something, so this sleeps until there is an event.
+    '''
+    clock.tick(fps)
+    if not redraw and len(renderer.animations) == 0:
+        return [pygame.event.wait()] + pygame.event.get()
+    return pygame.event.get()
+    
 class Menu(object):
     def __init__(self, renderer, things, title, options, size=200):
         self.renderer = renderer
@@ -111,23 +233,30 @@ class Menu(object):
         self.options = options.keys()
         self.funcs = options
         self.size = size
+        self.clock = pygame.time.Clock()
+        self.redraw = True
     
     def attach(self, option, func):
         self.funcs[option] = func
         
     def loop(self):
+        events = get_events(self.renderer, self.clock, self.redraw)
+        self.redraw = False
+        
         self.renderer.process(self.things)
         choice = self.renderer.draw_menu(self.title, self.options, self.size)
         self.renderer.display()
         
-        event = pygame.event.poll()
-        
-        if event.type == pygame.QUIT:
-            pygame.quit()
-            raise SystemExit(0)
-            
-        if choice is not None and event.type == pygame.MOUSEBUTTONDOWN:
-            return self.funcs[choice]()
+        for event in events:
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                raise SystemExit(0)
+                
+            if choice is not None and event.type == pygame.MOUSEBUTTONDOWN:
+                # Whatever comes next covers the menu, so draw it again
+                # straight away if we come back to it.
+                self.redraw = True
+                return self.funcs[choice]()
         
 class Dialog(object):
     def __init__(self, renderer, things, title, text, next=end_frame):
@@ -139,25 +268,47 @@ class Dialog(object):
         self.text = text
         self.text.extend(['', '(Press any key to continue)'])
         self.next = next
+        self.clock = pygame.time.Clock()
+        self.redraw = True
         
         
     def loop(self):
+        events = get_events(self.renderer, self.clock, self.redraw)
+        self.redraw = False
+        
         self.renderer.process(self.things)
         self.renderer.draw_dialog(self.title, self.text)
         self.renderer.display()
         
-        event = pygame.event.poll()
-        
-        if event.type == pygame.QUIT:
-            pygame.quit()
-            raise SystemExit(0) 
-        if event.type in [pygame.MOUSEBUTTONDOWN, pygame.KEYDOWN]:
-            self.next()
+        for event in events:
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                raise SystemExit(0) 
+            if event.type in [pygame.MOUSEBUTTONDOWN, pygame.KEYDOWN]:
+                self.next()
 
         
-def make_pause_menu(renderer, things):
+def resume(renderer, path, timer=None, events=None):
+    '''
+    A Gameloop that carries on with a wave saved by Gameloop.suspend. The
+    save is deleted, so the same wave can't be resumed twice.
+    '''
+    game = Gameloop(renderer, [], 0, timer, events, savestate.load(path))
+    os.remove(path)
+    return game
+    
+def save_and_quit(game):
+    game.suspend(SAVE_PATH)
+    end_game()
+        
+def toggle_profiler(game):
+    game.renderer.profiler.toggle()
+        
+def make_pause_menu(game):
+    renderer, things = game.renderer, game.things
     return Menu(renderer, things, 'Pause', collections.OrderedDict([
         ('Resume', end_frame), 
+        ('Save & quit', lambda: save_and_quit(game)),
         ('Quit', end_game), 
         ('About', lambda: make_about_dialog(renderer, things))
     ]))
@@ -181,12 +332,14 @@ def make_about_dialog(renderer, things):
         'By Michael Lee'
     ])
     
-def make_start_menu(renderer, things):
-    return Menu(renderer, things, 'ORBITAL SMASH', collections.OrderedDict([
-            ('Start game', lambda: end_frame_push_next(Gameloop(renderer, things, 0))),
-            ('About', lambda: make_about_dialog(renderer, things)),
-            ('Quit', end_game)
-        ]), 350)
+def make_start_menu(renderer, things, timer=None, events=None, resumable=True):
+    options = collections.OrderedDict()
+    if resumable and os.path.exists(SAVE_PATH):
+        options['Continue saved game'] = lambda: end_frame_push_next(resume(renderer, SAVE_PATH, timer, events))
+    options['Start game'] = lambda: end_frame_push_next(Gameloop(renderer, things, 0, timer, events))
+    options['About'] = lambda: make_about_dialog(renderer, things)
+    options['Quit'] = end_game
+    return Menu(renderer, things, 'ORBITAL SMASH', options, 350)
         
 def get_random_hint():
     pool = [
@@ -200,7 +353,10 @@ def get_random_hint():
     return random.choice(pool)
     
     
-def make_game_over(renderer, things, max_score):
+def make_game_over(renderer, things, max_score, timer=None, events=None):
+    # The score is worked out from the health enemies have left rather than
+    # from the collision buffer: enemies still queued, dead ones and damage
+    # past zero health all count the way they always have.
     score = max_score - sum([e.health for e in things if entities.Enemy in e])
     end_frame_push_next(
         Dialog(
@@ -217,7 +373,7 @@ def make_game_over(renderer, things, max_score):
                     things, 
                     'You lost.'.format(int(score)), 
                     collections.OrderedDict([
-                        ('Play again?', lambda: Gameloop(renderer, things, 0)),
+                        ('Play again?', lambda: Gameloop(renderer, things, 0, timer, events)),
                         ('Quit', end_game)
                     ])
                 )
@@ -225,7 +381,7 @@ def make_game_over(renderer, things, max_score):
         )
     )
     
-def make_continue_game(renderer, things, max_score):
+def make_continue_game(renderer, things, max_score, timer=None, events=None):
     score = max_score + sum([e.health for e in things if entities.Enemy in e]) # human health
     end_frame_push_next(
         Dialog(
@@ -238,25 +394,34 @@ def make_continue_game(renderer, things, max_score):
              'Hint!',
              get_random_hint()],
             lambda: end_frame_push_next(
-                Gameloop(renderer, things, score)
+                Gameloop(renderer, things, score, timer, events)
             )
         )
     )
             
     
     
-def mainloop():
-    renderer = graphics.Renderer()
+def mainloop(timer=None, events=None, renderer=None, resumable=True):
+    '''
+    Runs the game from the start menu. Every wave shares `timer` and
+    `events` if they are given, so they can follow a whole session.
+    Unless `resumable` is set, a saved wave isn't offered.
+    '''
+    renderer = renderer or graphics.Renderer(prebake=True)
     stack = []
-    stack.append(make_start_menu(renderer, []))
-    while True:
-        try:
-            next = stack[-1].loop()
-            if next is not None:
-                stack.append(next)
-        except EndFrame as ex:
-            stack.pop()
-        except EndFramePushNext as ex:
-            stack.pop()
-            stack.append(ex.next)
+    stack.append(make_start_menu(renderer, [], timer, events, resumable))
+    try:
+        while True:
+            try:
+                next = stack[-1].loop()
+                if next is not None:
+                    stack.append(next)
+            except EndFrame as ex:
+                stack.pop()
+            except EndFramePushNext as ex:
+                stack.pop()
+                stack.append(ex.next)
+    finally:
+        if len(renderer.profiler.frames) > 0:
+            renderer.profiler.dump('profile.json')
         
\ No newline at end of file
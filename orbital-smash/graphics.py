@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import pygame
+import collections
 import math
 import random
 import sys
@@ -8,6 +9,7 @@ import os.path
 
 import entities
 import physics
+import profiling
 
 
 def load_resource(relative_path):
@@ -21,19 +23,216 @@ def load_resource(relative_path):
 def load_image(path):
     return pygame.image.load(load_resource(path)).convert_alpha()
 
-def generate_stargrid(image_name, offset):
-    image = load_image(image_name)
-    field = []
-    for i in range(30):
-        position = physics.Cartesian(
-            random.randint(-offset, 800 + offset), 
-            random.randint(-offset, 800 + offset))
-        field.append({'image': image, 'dest': position})
-    return field
+BACKGROUND = (14, 2, 40) # A deep purple
+
+STARS_PER_LAYER = 30
+
+
+class StarLayer(object):
+    '''
+    Stars drawn once onto a tile the size of the screen. The tile moves up
+    to `depth` pixels away from the mouse, and wraps round at the edges
+    so that it always covers the screen in at most four blits. The bottom
+    layer is opaque and doubles as the background; layers above it are
+    keyed on the background colour so only their stars get drawn.
+    '''
+    def __init__(self, image_name, depth, size, rng=random, count=STARS_PER_LAYER, opaque=False):
+        image = load_image(image_name)
+        self.depth = depth
+        self.width, self.height = size
+        self.tile = pygame.Surface(size).convert()
+        self.tile.fill(BACKGROUND)
+        for i in xrange(count):
+            x, y = rng.randrange(self.width), rng.randrange(self.height)
+            # Stars hanging off one edge show up again at the other.
+            for dx in (0, -self.width):
+                for dy in (0, -self.height):
+                    self.tile.blit(image, (x + dx, y + dy))
+        if not opaque:
+            self.tile.set_colorkey(BACKGROUND, pygame.RLEACCEL)
+    
+    def draw(self, screen, x, y):
+        left = -((x - self.width / 2) * self.depth // (self.width / 2)) % self.width
+        top = -((y - self.height / 2) * self.depth // (self.height / 2)) % self.height
+        for dx in ((0,) if left == 0 else (-self.width, 0)):
+            for dy in ((0,) if top == 0 else (-self.height, 0)):
+                screen.blit(self.tile, (left + dx, top + dy))
+                
+
+# Collision radius of each sprite, as assigned by Renderer.initialize.
+RADII = {
+    entities.HumanSprite: 8,
+    entities.RockSprite: 21,
+    entities.SteelSprite: 21,
+    entities.UfoSprite: 22,
+    entities.ShooterSprite: 25,
+    entities.MineSprite: 12,
+    entities.BulletSprite: 4,
+    entities.StarSprite: 8,
+}
+MAX_RADIUS = max(RADII.values())
+
+
+def get_bytes(value):
+    '''Memory taken by a surface, or by a list of them.'''
+    if isinstance(value, list):
+        return sum(get_bytes(image) for image in value)
+    return value.get_width() * value.get_height() * value.get_bytesize()
+
+
+class SurfaceCache(object):
+    '''
+    Surfaces made by `make(key)`, kept until they are the least recently
+    used and together take up more than `max_bytes`. Subclasses define
+    `make`.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.surfaces = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def get(self, key):
+        value = self.surfaces.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return self.add(key)
+        self.hits += 1
+        self.surfaces[key] = value
+        return value
+        
+    def add(self, key):
+        value = self.surfaces[key] = self.make(key)
+        self.grow(get_bytes(value))
+        return value
+        
+    def grow(self, size):
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            oldest, dropped = self.surfaces.popitem(last=False)
+            self.bytes -= get_bytes(dropped)
+            self.evictions += 1
+        
+        
+class RotationCache(SurfaceCache):
+    '''
+    Rotated copies of images, with angles rounded to one of `steps` per
+    turn.
+    '''
+    def __init__(self, steps=180, max_bytes=32 * 1024 * 1024):
+        SurfaceCache.__init__(self, max_bytes)
+        self.steps = steps
+        
+    def make(self, key):
+        image, step = key
+        return pygame.transform.rotate(image, step * 360.0 / self.steps)
         
+    def rotate(self, image, degrees):
+        return self.get((image, int(round(degrees * self.steps / 360.0)) % self.steps))
+        
+    def prebake(self, images):
+        '''Rotates each of `images` to every step ahead of time.'''
+        for image in images:
+            for step in xrange(self.steps):
+                if (image, step) not in self.surfaces:
+                    self.add((image, step))
+                    
+                    
+class ExplosionCache(SurfaceCache):
+    '''
+    Frames of blast wave animations. A wave starts as its image turned to
+    one of `angle_steps` angles and stretched to one of `size_steps`
+    sizes along each side, then grows by `growth` pixels, then one less,
+    and so on until it is gone. Every frame is scaled from the starting
+    image, and only once, when it is first played.
+    '''
+    def __init__(self, angle_steps=8, size_steps=3, max_bytes=64 * 1024 * 1024):
+        SurfaceCache.__init__(self, max_bytes)
+        self.angle_steps = angle_steps
+        self.size_steps = size_steps
+        self.turned = RotationCache(angle_steps, 16 * 1024 * 1024)
+        
+    def get_key(self, image, growth, size, turn, stretch_x, stretch_y):
+        '''
+        Picks the wave for fractions `turn` of a full turn and `stretch_x`
+        and `stretch_y` of `size`.
+        '''
+        def stretch(fraction):
+            return 51 + int((int(fraction * self.size_steps) + 0.5) * size / self.size_steps)
+        return (image, int(turn * self.angle_steps), stretch(stretch_x), stretch(stretch_y), growth)
+        
+    def make(self, key):
+        image, angle, width, height, growth = key
+        start = self.turned.rotate(image, angle * 360.0 / self.angle_steps)
+        return [pygame.transform.scale(start, (width, height))]
+        
+    def get_frame(self, key, index):
+        '''Frame `index` of the wave picked by `get_key`.'''
+        frames = self.get(key)
+        while len(frames) <= index + 1:
+            width, height = frames[-1].get_size()
+            step = key[-1] - (len(frames) - 1)
+            frame = pygame.transform.scale(frames[0], (width + step, height + step))
+            frames.append(frame)
+            self.grow(get_bytes(frame))
+        return frames[index + 1]
 
+
+class TextCache(SurfaceCache):
+    '''Lines of text, rendered once for each font, string and colour.'''
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        SurfaceCache.__init__(self, max_bytes)
+        
+    def make(self, key):
+        font, text, color = key
+        return font.render(text, True, color)
+        
+    def render(self, font, text, color):
+        return self.get((font, text, color))
+        
+        
+class PanelCache(SurfaceCache):
+    '''
+    Menu and dialog boxes, each composited once: a translucent white box
+    `width` wide with the title and then the `lines` as (text, colour)
+    pairs. A menu makes one of these per option the mouse is over.
+    '''
+    def __init__(self, title_font, font, text, max_bytes=8 * 1024 * 1024):
+        SurfaceCache.__init__(self, max_bytes)
+        self.title_font = title_font
+        self.font = font
+        self.text = text
+        
+    def make(self, key):
+        title, lines, width = key
+        panel = pygame.Surface((width, 40 + len(lines) * 20 + 10), pygame.SRCALPHA)
+        panel.fill((255, 255, 255, 200))
+        
+        color = (0, 150, 33)
+        if "lost" in title:
+            color = (255, 0, 0)
+        panel.blit(self.text.render(self.title_font, title, color), (10, 10))
+        
+        counter = 50
+        for line, color in lines:
+            panel.blit(self.text.render(self.font, line, color), (10, counter))
+            counter += 20
+        return panel
+        
+        
 class Renderer(object):
-    def __init__(self, size=(800, 800), caption="Orbital Smash"):
+    '''
+    With `dirty_rects` set, only the parts of the screen that changed are
+    redrawn and sent to the display: each frame puts the background back
+    under whatever was drawn the frame before, and updates those areas
+    plus the ones drawn this frame. The starfield stays still in this mode,
+    since moving it would change the whole screen. Overlays that cover the
+    screen, like menus, fall back to a full redraw.
+    '''
+    def __init__(self, size=(800, 800), caption="Orbital Smash", prebake=False, dirty_rects=False,
+                 rotation_steps=180):
         pygame.init()
         
         self.size = size
@@ -60,75 +259,100 @@ class Renderer(object):
         self.blast_wave_minor = load_image(r'images\blast_wave_yellow.png')
         self.blast_wave_player_death = load_image(r'images\blast_wave_green.png')
         
-        self.large_starfield = generate_stargrid(r'images\spaceArt\png\Background\starBig.png', 16)
-        self.small_starfield = generate_stargrid(r'images\spaceArt\png\Background\starSmall.png', 8)
+        # Purely cosmetic randomness comes from here rather than the global
+        # generator, so what gets drawn can't change how the game plays out.
+        self.random = random.Random()
+        
+        self.starfield = [
+            StarLayer(r'images\spaceArt\png\Background\starBig.png', 16, size, self.random, opaque=True),
+            StarLayer(r'images\spaceArt\png\Background\starSmall.png', 8, size, self.random)]
         
         self.title_font = pygame.font.Font(load_resource(r'fonts\orbitron\OrbitronMedium.ttf'), 32)
         self.font = pygame.font.Font(load_resource(r'fonts\orbitron\OrbitronMedium.ttf'), 16)
+        self.small_font = pygame.font.Font(load_resource(r'fonts\orbitron\OrbitronMedium.ttf'), 11)
         
         self.animations = []
+        self.profiler = profiling.FrameProfiler()
+        
+        # Areas drawn to this frame and last frame. None means the whole
+        # screen, and `drawn` is always None unless in dirty rect mode.
+        self.dirty_rects = dirty_rects
+        self.background = None
+        self.dirty = None
+        self.drawn = [] if dirty_rects else None
+        
+        # Sprites turn in steps of 360 / rotation_steps degrees.
+        self.rotations = RotationCache(rotation_steps)
+        self.explosions = ExplosionCache()
+        self.text = TextCache()
+        self.panels = PanelCache(self.title_font, self.font, self.text)
+        self.shade = None
+        if prebake:
+            self.rotations.prebake([
+                self.rock_image, 
+                self.steel_rock_image, 
+                self.ufo_image, 
+                self.shooter_image, 
+                self.mine_image, 
+                self.star_image])
         
     def initialize(self, things):
         for e in things:
             if entities.HumanSprite in e:
                 e.scaled_image = e.image = self.human_image
-                e.radius = 8
+                e.radius = RADII[entities.HumanSprite]
             if entities.RockSprite in e:
                 e.scaled_image = e.image = self.rock_image
-                e.radius = 21
+                e.radius = RADII[entities.RockSprite]
             if entities.SteelSprite in e:
                 e.scaled_image = e.image = self.steel_rock_image
-                e.radius = 21
+                e.radius = RADII[entities.SteelSprite]
             if entities.UfoSprite in e:
                 e.scaled_image = e.image = self.ufo_image
-                e.radius = 22
+                e.radius = RADII[entities.UfoSprite]
             if entities.ShooterSprite in e:
                 e.scaled_image = e.image = self.shooter_image
-                e.radius = 25
+                e.radius = RADII[entities.ShooterSprite]
             if entities.MineSprite in e:
                 e.scaled_image = e.image = self.mine_image
-                e.radius = 12
+                e.radius = RADII[entities.MineSprite]
             if entities.BulletSprite in e:
                 e.scaled_image = e.image = self.bullet_image
-                e.radius = 4
+                e.radius = RADII[entities.BulletSprite]
             if entities.StarSprite in e:
                 e.scaled_image = e.image = self.star_image
-                e.radius = 8
+                e.radius = RADII[entities.StarSprite]
             
-    def process(self, things):
-        self.clear_screen()
-        
-        self.draw_starfield(pygame.mouse.get_pos())
+    def process(self, things, collisions=()):
+        if self.dirty_rects:
+            self.restore_background()
+        else:
+            self.draw_starfield(pygame.mouse.get_pos())
         
         new_animations = []
         
-        for animation in self.animations:
-            centerpoint, growth, image = animation
-            width, height = image.get_size()
-            image = pygame.transform.scale(image, ((width + growth), (height + growth)))
-            self.draw_image(image, centerpoint)
-            growth -= 1
-            if growth > 0:
-                new_animations.append((centerpoint, growth, image))
+        for centerpoint, key, index in self.animations:
+            self.draw_image(self.explosions.get_frame(key, index), centerpoint)
+            if index + 1 < key[-1]:
+                new_animations.append((centerpoint, key, index + 1))
         self.animations = new_animations
-            
         
+        for first, second, point, reason, impulse, damage_first, damage_second in collisions:
+            if reason == 'Collision':
+                self.add_explosion((2, 3), point, 4, self.blast_wave_minor, 127)
+            elif reason == 'Bullet':
+                self.add_explosion((2, 3), point, 4, self.blast_wave, 127)
+            
         for e in things:
             if entities.Rotates in e:
-                e.scaled_image = pygame.transform.rotate(e.image, e.angle/math.pi * 180)
+                e.scaled_image = self.rotations.rotate(e.image, e.angle/math.pi * 180)
             if entities.Drawable in e:
                 self.draw_image(e.scaled_image, e.position)
             if entities.Dead in e:
                 if entities.UserControllable in e:
-                    self.add_explosion((4, 6), e.position, 20, self.blast_wave_player_death, 255)
+                    self.add_explosion((4, 6), e.position.copy(), 20, self.blast_wave_player_death, 255)
                 elif entities.Bullet not in e:
-                    self.add_explosion((4, 6), e.position, 20, self.blast_wave, 255)
-            if entities.Explosion in e:
-                if e.reason == 'Collision':
-                    self.add_explosion((2, 3), e.position, 4, self.blast_wave_minor, 127)
-                elif e.reason == 'Bullet':
-                    self.add_explosion((2, 3), e.position, 4, self.blast_wave, 127)
-                    
+                    self.add_explosion((4, 6), e.position.copy(), 20, self.blast_wave, 255)
             if entities.Damageable in e:
                 # Boundary
                 if e.health != e.max_health and e.health > 0:
@@ -136,123 +360,141 @@ class Renderer(object):
                     sides = int(10.0 * e.health / e.max_health) + 1
                     corner = (e.position.x - sides, e.position.y - height / 2 - 10)
                     size = (sides * 2, 5)
-                    pygame.draw.rect(self.screen, (255, 0, 0), pygame.Rect(corner, size))
+                    self.mark(pygame.draw.rect(self.screen, (255, 0, 0), pygame.Rect(corner, size)))
             if entities.Collector in e:
-                for orbiting in e.collected_objects:
+                for handle in e.collected_objects:
+                    orbiting = entities.resolve(handle)
+                    if orbiting is None:
+                        continue
                     distance = physics.get_distance(orbiting.position, e.position) 
                     width = 7 - 5 * distance / e.draw_radius
-                    pygame.draw.line(
+                    self.mark(pygame.draw.line(
                         self.screen, 
                         (0, 255, 0), 
                         e.position.pos(),
                         orbiting.position.pos(), 
-                        int(width))
+                        int(width)))
                         
     def add_explosion(self, wave_range, position, growth, image, size):
-        for i in xrange(random.randint(*wave_range)):
-            image = pygame.transform.rotate(image, random.random() * 360)
-            scale = (int(51 + random.random() * size), int(51 + random.random() * size))
-            image = pygame.transform.scale(image, scale)
-            self.animations.append((position, growth, image))
+        for i in xrange(self.random.randint(*wave_range)):
+            key = self.explosions.get_key(
+                image, growth, size, self.random.random(), self.random.random(), self.random.random())
+            self.animations.append((position, key, 0))
                         
     def draw_image(self, image, position):
         width, height = image.get_size()
         x, y = position.pos()
-        self.screen.blit(image, (x - width / 2, y - height / 2))
+        self.mark(self.screen.blit(image, (x - width / 2, y - height / 2)))
+        
+    def mark(self, rect):
+        if self.drawn is not None:
+            self.drawn.append(rect)
+            
+    def mark_all(self):
+        if self.dirty_rects:
+            self.drawn = None
+            
+    def restore_background(self):
+        if self.background is None:
+            self.draw_starfield((self.size[0] / 2, self.size[1] / 2))
+            self.background = self.screen.copy()
+        if self.dirty is None:
+            self.screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.dirty:
+                self.screen.blit(self.background, rect, rect)
                 
     def draw_starfield(self, input_coords):
+        '''Covers the whole screen, so there's no need to clear it first.'''
         x, y = input_coords
-        offset = physics.Cartesian(x - 400, y - 400)
-        for star in self.large_starfield:
-            self.screen.blit(
-                star['image'],
-                (star['dest'] - offset * 16 / 400).pos())
-        for star in self.small_starfield:
-            self.screen.blit(
-                star['image'],
-                (star['dest'] - offset * 8 / 400).pos())
+        for layer in self.starfield:
+            layer.draw(self.screen, x, y)
                 
     def shadeout(self):
-        shade = pygame.Surface((800, 800))
-        shade.set_alpha(200)
-        shade.fill((0,0,0))
-        self.screen.blit(shade, (0, 0))
-        
-    def draw_menu_background(self, width, height):
-        menu = pygame.Surface((width, height))
-        menu.set_alpha(200)
-        menu.fill((255,255,255))
-        self.screen.blit(menu, (400 - width/2, 400 - height / 2))
+        self.mark_all()
+        if self.shade is None:
+            self.shade = pygame.Surface(self.size)
+            self.shade.set_alpha(200)
+            self.shade.fill((0,0,0))
+        self.screen.blit(self.shade, (0, 0))
+        
+    def draw_panel(self, title, lines, width):
+        panel = self.panels.get((title, tuple(lines), width))
+        self.screen.blit(panel, (400 - width / 2, 400 - panel.get_height() / 2))
                 
     def draw_menu(self, menu_name, options, size=200):
         self.shadeout()
         height = 40 + len(options) * 20 + 10
-        self.draw_menu_background(size, height)
-        counter = 400 - height / 2 + 10
-        
-        color = (0, 150, 33)
-        if "lost" in menu_name:
-            color = (255, 0, 0)
-        
-        self.screen.blit(self.title_font.render(
-            menu_name,
-            True,
-            color,
-        ), (400 - size/2 + 10, counter))
-        
-        counter += 40
+        counter = 400 - height / 2 + 50
+        mouse = pygame.mouse.get_pos()
         
         current = None
+        lines = []
         
         for option in options:
             display = pygame.Rect((400 - size/2 + 5, counter - 2), (190, 20))
-            if display.collidepoint(pygame.mouse.get_pos()):
+            if display.collidepoint(mouse):
                 current = option
-                color = (0, 150, 33) # green
-                extra = "=> {0} <="
+                lines.append(("=> {0} <=".format(option), (0, 150, 33))) # green
             else:
-                color = (14,2,40) 
-                extra = "-> {0}"
-                
-            self.screen.blit(self.font.render(
-                extra.format(option),
-                True,
-                color
-            ), (400 - size/2 + 10, counter))
+                lines.append(("-> {0}".format(option), (14,2,40)))
             counter += 20
             
+        self.draw_panel(menu_name, lines, size)
         return current
         
     def draw_dialog(self, menu_name, text):
         self.shadeout()
-        height = 40 + len(text) * 20 + 10
-        self.draw_menu_background(500, height)
-        counter = 400 - height / 2 + 10
-        
-        color = (0, 150, 33)
-        if "lost" in menu_name:
-            color = (255, 0, 0)
-        
-        self.screen.blit(self.title_font.render(
-            menu_name,
-            True,
-            color
-        ), (160, counter))
+        self.draw_panel(menu_name, [(t, (14,2,40)) for t in text], 500)
+
+    def draw_profiler(self):
+        # Frame-time graph in the top left corner; the white line is the
+        # 20 ms budget of a 50 fps frame.
+        width, height = 250, 60
+        scale = height / 40.0 # pixels per millisecond
+        panel = pygame.Rect((10, 10), (width, height))
+        self.mark(pygame.draw.rect(self.screen, (0, 0, 0), panel))
         
-        counter += 40
+        totals = self.profiler.totals()[-width:]
+        for i, total in enumerate(totals):
+            bar = min(height, int(total * 1000 * scale))
+            color = (0, 200, 0) if total <= 0.02 else (255, 0, 0)
+            pygame.draw.line(
+                self.screen, 
+                color, 
+                (panel.left + i, panel.bottom), 
+                (panel.left + i, panel.bottom - bar))
+        budget = panel.bottom - int(20 * scale)
+        pygame.draw.line(self.screen, (255, 255, 255), (panel.left, budget), (panel.right, budget))
         
-        for t in text:
-            self.screen.blit(self.font.render(
-                t,
-                True,
-                (14,2,40)
-            ), (160, counter))
-            counter += 20
-
+        summary = self.profiler.summary()
+        lines = ['p50 {0:.1f} ms   p95 {1:.1f} ms   p99 {2:.1f} ms'.format(
+            summary['p50'] * 1000, summary['p95'] * 1000, summary['p99'] * 1000)]
+        if len(self.profiler.frames) > 0:
+            last = self.profiler.frames[-1]
+            lines.append('   '.join('{0} {1:.1f}'.format(stage, seconds * 1000) 
+                for stage, seconds in last['stages'].items()))
+            lines.append('entities {0}   +{1} -{2}'.format(
+                last['entities'], last['spawned'], last['despawned']))
+        for name, cache in [('rotations', self.rotations), ('explosions', self.explosions)]:
+            lines.append('{0} {1} hit {2} miss {3:.1f} MB'.format(
+                name, cache.hits, cache.misses, cache.bytes / 1048576.0))
+                
+        counter = panel.bottom + 4
+        for line in lines:
+            self.mark(self.screen.blit(self.small_font.render(line, True, (255, 255, 255)), (10, counter)))
+            counter += 14
+            
     def clear_screen(self):
-        self.screen.fill((14,2,40)) # A deep purple
+        self.screen.fill(BACKGROUND)
         
     def display(self):
-        pygame.display.flip()
+        if self.drawn is None or self.dirty is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.dirty + self.drawn)
+        if self.dirty_rects:
+            self.dirty = self.drawn
+            self.drawn = []
         
         
\ No newline at end of file
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+'''
+A flow field toward the player, shared by every enemy that chases them.
+
+The arena is cut into a grid, and a search out from the player's cell
+gives each cell its distance around the obstacles (Solid bodies that
+can't be damaged, i.e. steel rocks). Each cell then stores which way to
+go: nothing if the straight line to the player is clear, or else the
+first step of the shortest way round. An enemy looks its direction up by
+cell, so the cost of the search is paid a few times a second no matter
+how many enemies are chasing.
+'''
+
+import math
+
+import entities
+
+ARENA_SIZE = 800
+CELL_SIZE = 20
+
+# Obstacles are grown by this much so that enemies steer clear with their
+# edge and not just their middle. Matches the largest sprite radius.
+CLEARANCE = 25
+
+# Milliseconds between rebuilds.
+INTERVAL = 250
+
+NEIGHBOURS = [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx != 0 or dy != 0]
+# Diagonal steps cost about sqrt(2) times as much as straight ones.
+COSTS = [7 if dx != 0 and dy != 0 else 5 for dx, dy in NEIGHBOURS]
+DIRECTIONS = [(dx / math.hypot(dx, dy), dy / math.hypot(dx, dy)) for dx, dy in NEIGHBOURS]
+
+UNREACHED = float('inf')
+
+# Enemies that steer by the field.
+CHASERS = (entities.TrackingPath, entities.BulldozePath)
+
+
+def find_obstacles(things):
+    return [e for e in entities.query(things, entities.Solid) if entities.Damageable not in e]
+
+
+def is_hidden(vx, vy, relative):
+    '''
+    Whether the line from the player to the point (vx, vy) away from them
+    passes within reach of any of the `relative` obstacles, given as their
+    offset from the player and their squared reach.
+    '''
+    length_squared = vx * vx + vy * vy
+    if length_squared == 0:
+        return False
+    for ox, oy, reach_squared in relative:
+        t = min(max((ox * vx + oy * vy) / length_squared, 0), 1)
+        if (ox - t * vx) ** 2 + (oy - t * vy) ** 2 <= reach_squared:
+            return True
+    return False
+
+
+grids = {}
+
+def get_grid(columns, cell_size):
+    '''
+    The middle of every cell, and the cells next to each one with the
+    cost and direction of the step there and the two cells that step
+    passes between. A diagonal step is only allowed if neither of those is
+    blocked, so that it doesn't cut the corner of an obstacle.
+    '''
+    grid = grids.get((columns, cell_size))
+    if grid is None:
+        centers = []
+        links = []
+        for cell in xrange(columns * columns):
+            column, row = cell % columns, cell // columns
+            centers.append(((column + 0.5) * cell_size, (row + 0.5) * cell_size))
+            neighbours = []
+            for (dx, dy), cost, direction in zip(NEIGHBOURS, COSTS, DIRECTIONS):
+                x, y = column + dx, row + dy
+                if 0 <= x < columns and 0 <= y < columns:
+                    neighbours.append(
+                        (y * columns + x, cost, row * columns + x, y * columns + column, direction))
+            links.append(neighbours)
+        grid = grids[(columns, cell_size)] = (centers, links)
+    return grid
+
+
+class FlowField(object):
+    '''
+    `flow` holds one entry per cell, row by row: None where an enemy
+    should head straight for the player (or the field has nothing better
+    to offer), otherwise a unit (x, y) direction. `detours` counts the
+    cells that aren't None, so callers can skip sampling altogether when
+    nothing is in the way.
+    '''
+    def __init__(self, size=ARENA_SIZE, cell_size=CELL_SIZE, clearance=CLEARANCE, interval=INTERVAL):
+        self.cell_size = cell_size
+        self.columns = int(math.ceil(size / float(cell_size)))
+        self.clearance = clearance
+        self.interval = interval
+        self.centers, self.links = get_grid(self.columns, cell_size)
+        self.reset()
+
+    def reset(self):
+        '''Empties the field, so that the next `update` rebuilds it.'''
+        self.flow = [None] * len(self.centers)
+        self.detours = 0
+        self.key = None
+        self.next_update = None
+
+    def get_cell(self, x, y):
+        last = self.columns - 1
+        column = min(max(int(x // self.cell_size), 0), last)
+        row = min(max(int(y // self.cell_size), 0), last)
+        return row * self.columns + column
+
+    def sample(self, position):
+        '''The direction to take from `position`, or None to head straight.'''
+        if self.detours == 0:
+            return None
+        return self.flow[self.get_cell(position.x, position.y)]
+
+    def update(self, things, humans, time):
+        '''
+        Rebuilds the field if `interval` has passed since the last time and
+        anything is chasing. It only leads somewhere when there is exactly
+        one human to chase.
+        '''
+        if self.next_update is not None and time < self.next_update:
+            return
+        chasers = [e for chaser in CHASERS for e in entities.query(things, chaser)]
+        if len(chasers) == 0:
+            return
+        if len(humans) != 1:
+            self.reset()
+            self.next_update = time + self.interval
+            return
+        self.next_update = time + self.interval
+
+        goal = humans[0].position
+        gx, gy = goal.x, goal.y
+        obstacles = [(e.position.x, e.position.y, e.radius + self.clearance)
+                     for e in find_obstacles(things)]
+        relative = [(ox - gx, oy - gy, reach * reach) for ox, oy, reach in obstacles]
+
+        # Until something is actually cut off from the player, the field
+        # would only ever say to head straight for them.
+        if not any(is_hidden(e.position.x - gx, e.position.y - gy, relative) for e in chasers):
+            if self.detours > 0:
+                self.flow = [None] * len(self.centers)
+                self.detours = 0
+            self.key = None
+            return
+
+        # Nothing to do if neither the player nor any obstacle has changed
+        # cell since the last rebuild.
+        key = (self.get_cell(gx, gy),
+               tuple((self.get_cell(x, y), reach) for x, y, reach in obstacles))
+        if key == self.key:
+            return
+        self.key = key
+        self.rebuild(gx, gy, obstacles)
+
+    def rebuild(self, gx, gy, obstacles):
+        columns = self.columns
+        centers = self.centers
+        count = len(centers)
+        self.flow = flow = [None] * count
+        self.detours = 0
+        if len(obstacles) == 0:
+            return
+
+        blocked = [False] * count
+        for ox, oy, reach in obstacles:
+            first = self.get_cell(ox - reach, oy - reach)
+            last = self.get_cell(ox + reach, oy + reach)
+            for row in xrange(first // columns, last // columns + 1):
+                for cell in xrange(row * columns + first % columns, row * columns + last % columns + 1):
+                    cx, cy = centers[cell]
+                    if (cx - ox) ** 2 + (cy - oy) ** 2 <= reach * reach:
+                        blocked[cell] = True
+
+        goal = self.get_cell(gx, gy)
+        blocked[goal] = False
+
+        # The cells that can't see the player past an obstacle are the only
+        # ones that need a direction.
+        relative = [(ox - gx, oy - gy, reach * reach) for ox, oy, reach in obstacles]
+        hidden = [cell for cell in xrange(count)
+                  if not blocked[cell] and cell != goal
+                  and is_hidden(centers[cell][0] - gx, centers[cell][1] - gy, relative)]
+        if len(hidden) == 0:
+            return
+
+        # Step costs are small integers, so cells waiting to be visited are
+        # kept in one list per distance rather than in a heap. The search
+        # stops once every hidden cell has its final distance.
+        links = self.links
+        distance = [UNREACHED] * count
+        distance[goal] = 0
+        waiting = [False] * count
+        for cell in hidden:
+            waiting[cell] = True
+        left = len(hidden)
+        frontier = [[goal]]
+        cost = 0
+        while cost < len(frontier) and left > 0:
+            for cell in frontier[cost]:
+                if cost > distance[cell]:
+                    continue
+                if waiting[cell]:
+                    waiting[cell] = False
+                    left -= 1
+                for other, step, side, other_side, direction in links[cell]:
+                    new = cost + step
+                    if new < distance[other] and not (
+                            blocked[other] or blocked[side] or blocked[other_side]):
+                        distance[other] = new
+                        while len(frontier) <= new:
+                            frontier.append([])
+                        frontier[new].append(other)
+            cost += 1
+
+        for cell in hidden:
+            if distance[cell] == UNREACHED:
+                continue
+            # Of the steps on a shortest path, take the one most in line
+            # with the player.
+            cx, cy = centers[cell]
+            best = None
+            for other, step, side, other_side, direction in links[cell]:
+                if distance[other] + step != distance[cell] or blocked[side] or blocked[other_side]:
+                    continue
+                alignment = direction[0] * (gx - cx) + direction[1] * (gy - cy)
+                if best is None or alignment > best[0]:
+                    best = (alignment, direction)
+            if best is not None:
+                flow[cell] = best[1]
+                self.detours += 1
@@ -6,14 +6,13 @@ import random
 
 import entities
 
-def remove(list, item):
-    del list[list.index(item)]
-
 def get_distance(a, b):
-    return (a - b).to_polar().magnitude
+    return (a - b).length()
     
 
 class Cartesian(object):
+    __slots__ = ('x', 'y')
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -36,11 +35,43 @@ class Cartesian(object):
     def dot(self, other):
         return self.x * other.x + self.y * other.y
         
-    def magnitude(self):
-        return self.to_polar().magnitude
+    def length_squared(self):
+        return self.x * self.x + self.y * self.y
+        
+    def length(self):
+        return math.sqrt(self.x * self.x + self.y * self.y)
         
     def angle(self):
-        return self.to_polar().angle
+        return math.atan2(self.y, self.x)
+        
+    def normalize(self):
+        # A zero vector becomes (1, 0), same as Polar(0, atan2(0, 0)) would
+        # give after setting its magnitude to 1.
+        length = self.length()
+        if length == 0:
+            self.x = 1.0
+            self.y = 0.0
+        else:
+            self.x /= length
+            self.y /= length
+        return self
+        
+    def clamp_length(self, maximum):
+        length = self.length()
+        if length > maximum:
+            self.x *= maximum / length
+            self.y *= maximum / length
+        return self
+        
+    def iadd(self, other):
+        self.x += other.x
+        self.y += other.y
+        return self
+        
+    def imul(self, num):
+        self.x *= num
+        self.y *= num
+        return self
         
     def __add__(self, other):
         return Cartesian(self.x + other.x, self.y + other.y)
@@ -57,6 +88,9 @@ class Cartesian(object):
     def __rmul__(self, num):
         return self.__mul__(num)
         
+    __iadd__ = iadd
+    __imul__ = imul
+        
     def __repr__(self):
         return 'Cartesian({0}, {1})'.format(self.x, self.y)
         
@@ -90,16 +124,12 @@ def is_colliding(a, b):
     
 def calculate_midpoint(position_1, position_2, radius_1, radius_2):
     normal = calculate_normal(position_1, position_2)
-    normal = normal.to_polar()
-    normal.magnitude = radius_2
-    intersection = position_2 + normal.to_cartesian()
-    return intersection
+    normal *= radius_2
+    normal += position_2
+    return normal
     
 def calculate_normal(center, intersection):
-    normal = center - intersection
-    normal = normal.to_polar()
-    normal.magnitude = 1
-    return normal.to_cartesian()
+    return (center - intersection).normalize()
     
 def hard_push(a, b, distance_1, distance_2):
     collision_point = calculate_midpoint(a, b, distance_1, distance_2)
@@ -128,17 +158,13 @@ def calculate_sphere_collision(a, b):
     normal = calculate_normal(a.position, collision_point)
     reflection = calculate_reflection(normal, a.velocity)
     
-    reflection = reflection.to_polar()
-    a_vel = a.velocity.to_polar()
-    b_vel = b.velocity.to_polar()
-    total_momentum = a.mass * a_vel.magnitude + b.mass * b_vel.magnitude
+    total_momentum = a.mass * a.velocity.length() + b.mass * b.velocity.length()
     new_magnitude = total_momentum / (a.mass + b.mass)
-    reflection.magnitude = new_magnitude
     
-    return reflection.to_cartesian()
+    return reflection.normalize().imul(new_magnitude)
     
 def calculate_individual_damage(object, step):
-    acceleration = object.velocity.magnitude() * step
+    acceleration = object.velocity.length() * step
     force = object.mass * acceleration
     return force
     
@@ -153,11 +179,110 @@ def calculate_damage(a, b, step):
     
         
     
+class CollisionEvents(object):
+    '''
+    Contacts resolved since the last `clear`, stored column by column in
+    lists that are reused from frame to frame rather than reallocated.
+    Iterating yields (first, second, point, reason, impulse, damage_first,
+    damage_second) tuples.
+    '''
+    fields = ('first', 'second', 'point', 'reason', 'impulse', 'damage_first', 'damage_second')
+    
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.capacity = 0
+        self.grow(capacity)
+        
+    def grow(self, capacity):
+        for field in self.fields:
+            column = getattr(self, field, [])
+            column.extend([None] * (capacity - self.capacity))
+            setattr(self, field, column)
+        self.capacity = capacity
+        
+    def add(self, first, second, point, reason, impulse, damage_first, damage_second):
+        if self.count == self.capacity:
+            self.grow(self.capacity * 2)
+        i = self.count
+        self.first[i] = first
+        self.second[i] = second
+        self.point[i] = point
+        self.reason[i] = reason
+        self.impulse[i] = impulse
+        self.damage_first[i] = damage_first
+        self.damage_second[i] = damage_second
+        self.count += 1
+        
+    def clear(self):
+        self.count = 0
+        
+    def __len__(self):
+        return self.count
+        
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield (self.first[i], self.second[i], self.point[i], self.reason[i], 
+                   self.impulse[i], self.damage_first[i], self.damage_second[i])
+        
+    
+class SpatialHash(object):
+    '''
+    Uniform grid broadphase. Cells are at least as wide as the largest
+    collision distance, so anything that can touch an entity lives in one
+    of the 3x3 cells around it.
+    '''
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.keys = {}
+        
+    def key(self, position):
+        return (int(math.floor(position.x / self.cell_size)), 
+                int(math.floor(position.y / self.cell_size)))
+        
+    def clear(self):
+        self.cells = {}
+        self.keys = {}
+        
+    def insert(self, e):
+        key = self.key(e.position)
+        self.keys[e] = key
+        self.cells.setdefault(key, []).append(e)
+        
+    def move(self, e):
+        if e not in self.keys:
+            return
+        old = self.keys[e]
+        key = self.key(e.position)
+        if key == old:
+            return
+        cell = self.cells[old]
+        del cell[cell.index(e)]
+        self.keys[e] = key
+        self.cells.setdefault(key, []).append(e)
+        
+    def near(self, e):
+        x, y = self.keys[e]
+        found = []
+        for i in (x - 1, x, x + 1):
+            for j in (y - 1, y, y + 1):
+                for other in self.cells.get((i, j), ()):
+                    if other is not e:
+                        found.append(other)
+        return found
+        
 
 class Physics(object):
-    def __init__(self, step):
+    def __init__(self, step, max_radius=25, store=None):
         self.gravity = -900
         self.step = step
+        # Optional vectorized.KinematicsStore. When present, Moveable
+        # entities are integrated together at the end of the step.
+        self.store = store
+        # Two touching bodies are at most 2 * max_radius + epsilon apart.
+        self.grid = SpatialHash(2 * max_radius + 1)
+        # Filled by process(); whoever drives the steps clears it.
+        self.collisions = CollisionEvents()
         
     def initialize(self, things):
         for e in things:
@@ -215,55 +340,70 @@ class Physics(object):
                     e.max_health = 1
         
     def process(self, things):
-        score = 0
-        collectors = [e for e in things if entities.Collector in e]
+        collectors = entities.query(things, entities.Collector)
         humans = [e for e in collectors if entities.UserControllable in e]
         if len(humans) == 0:
             human = None
         else:
             human = humans[0]
             
-        output = []
+        # Each touching pair is resolved once, when the body that comes first
+        # in this order is processed.
+        order = {}
+        self.grid.clear()
+        for i, e in enumerate(entities.query(things, entities.Solid)):
+            order[e] = i
+            self.grid.insert(e)
+            
+        moving = []
         for e in things:
             if entities.Solid in e:
-                for other in things:
-                    if other == e:
-                        continue
-                    if entities.Solid not in other:
-                        continue
+                later = [other for other in self.grid.near(e) if order[other] > order[e]]
+                for other in sorted(later, key=order.get):
                     if is_colliding(e, other):
+                        velocity = e.velocity.copy()
                         self.calculate_collision(e, other)
-                        self.calculate_entity_damage(e, other)
+                        self.grid.move(e)
+                        self.grid.move(other)
+                        damage_to_e, damage_to_other = self.calculate_entity_damage(e, other)
+                        
                         if entities.Bullet not in e and entities.Bullet not in other:
-                            explosion = entities.make_explosion(
-                                calculate_midpoint(e.position, other.position, e.radius, other.radius),
-                                'Collision')
-                            output.append(explosion)
+                            reason = 'Collision'
                         else:
-                            explosion = entities.make_explosion(
-                                calculate_midpoint(e.position, other.position, e.radius, other.radius),
-                                'Bullet')
-                            output.append(explosion)
+                            reason = 'Bullet'
+                        self.collisions.add(
+                            e, 
+                            other, 
+                            calculate_midpoint(e.position, other.position, e.radius, other.radius),
+                            reason,
+                            e.mass * get_distance(e.velocity, velocity),
+                            damage_to_e,
+                            damage_to_other)
                         
                 # Wall collision
                 self.calculate_wall_collision(e)
+                self.grid.move(e)
                 
             if entities.Orbitable in e:
                 for collector in collectors:
                     if not collector.is_collector_active:
                         continue
                     distance = get_distance(e.position, collector.position)
-                    if distance >= collector.draw_radius and e not in collector.collected_objects:
+                    
+                    collector.collected_objects = [
+                        handle for handle in collector.collected_objects
+                        if entities.resolve(handle) is not None and entities.Dead not in handle[0]]
+                    held = [handle[0] for handle in collector.collected_objects]
+                    
+                    if distance >= collector.draw_radius and e not in held:
                         continue
                         
-                    if len(collector.collected_objects) < collector.max_collectable:                    
-                        if e not in collector.collected_objects:
-                            collector.collected_objects.append(e)
-                            
-                    for orbiting in collector.collected_objects:
-                        if entities.Dead in orbiting:
-                            remove(collector.collected_objects, orbiting)
+                    if len(held) < collector.max_collectable:                    
+                        if e not in held:
+                            collector.collected_objects.append(e.handle())
+                            held.append(e)
                             
+                    for orbiting in held:
                         o_distance = get_distance(orbiting.position, collector.position)
                         
                         normal = calculate_normal(collector.position, orbiting.position)
@@ -274,27 +414,27 @@ class Physics(object):
                         if o_distance < collector.push_radius + orbiting.radius:
                             orbiting.position = collector.position - (collector.push_radius + orbiting.radius) * normal
                         
-                        normal.magnitude = orbiting.mass * collector.mass / o_distance**2
                         orbiting.velocity += normal
+                        self.grid.move(orbiting)
                                 
-            if entities.Moveable in e:
+            if entities.Moveable in e and self.store is not None:
+                moving.append(e)
+            elif entities.Moveable in e:
                 e.velocity += e.acceleration
                 e.velocity *= e.dampening
                 
-                e.velocity = e.velocity.to_polar()
-                if e.velocity.magnitude >= 15:
-                    e.velocity.magnitude = 15
-                e.velocity = e.velocity.to_cartesian()
+                e.velocity.clamp_length(15)
                 
                 e.position += e.velocity
+                self.grid.move(e)
                 
             if entities.Rotates in e:
                 if entities.FacesUser in e:
                     if human is not None:
-                        vector = (e.position - human.position).to_polar()
-                        e.angle = -vector.angle
+                        e.angle = -(e.position - human.position).angle()
                     
-        return output
+        if self.store is not None:
+            self.store.integrate(moving)
             
     def calculate_collision(self, e, other):
         e.position, other.position = fix_overlap(e, other)
@@ -335,6 +475,7 @@ class Physics(object):
             other.health -= damage_to_b
             if other.health <= 0:
                 other.add(entities.Dead)
+        return damage_to_a, damage_to_b
         
                 
             
\ No newline at end of file
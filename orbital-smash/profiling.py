@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import collections
+import json
+import timeit
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+class FrameProfiler(object):
+    '''
+    Keeps per-frame stage timings, entity counts per component and spawn/
+    despawn counts for the last `size` frames.
+
+    Every hook returns straight away unless the profiler is enabled, so the
+    game loop can call them unconditionally.
+    '''
+    def __init__(self, size=500):
+        self.enabled = False
+        self.frames = collections.deque(maxlen=size)
+        self.current = None
+        self.last = 0
+
+    def toggle(self):
+        self.enabled = not self.enabled
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.current = {
+            'stages': collections.OrderedDict(),
+            'spawned': 0,
+            'despawned': 0,
+        }
+        self.last = timeit.default_timer()
+
+    def mark(self, stage):
+        '''Charges the time since the previous mark to `stage`.'''
+        if self.current is None:
+            return
+        now = timeit.default_timer()
+        stages = self.current['stages']
+        stages[stage] = stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def spawned(self, count):
+        if self.current is not None:
+            self.current['spawned'] += count
+
+    def despawned(self, count):
+        if self.current is not None:
+            self.current['despawned'] += count
+
+    def end(self, things):
+        if self.current is None:
+            return
+        components = collections.Counter()
+        for e in things:
+            components.update(e.components)
+        self.current['components'] = dict(components)
+        self.current['entities'] = len(things)
+        self.current['total'] = sum(self.current['stages'].values())
+        self.frames.append(self.current)
+        self.current = None
+
+    def totals(self):
+        return [frame['total'] for frame in self.frames]
+
+    def summary(self):
+        totals = self.totals()
+        return collections.OrderedDict([
+            ('frames', len(totals)),
+            ('p50', percentile(totals, 0.50)),
+            ('p95', percentile(totals, 0.95)),
+            ('p99', percentile(totals, 0.99)),
+        ])
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({
+                'summary': self.summary(),
+                'frames': list(self.frames),
+            }, f, indent=2)
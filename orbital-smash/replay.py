@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+'''
+Records a session to a small binary log and plays it back.
+
+Once the random seed is fixed, a session only depends on where the mouse
+was and how long each frame took (and on whether physics ran with the
+numpy store, which moves things slightly differently), so the log is the
+seed and that mode followed by one 7-byte record per game frame. Playback drives the same Gameloop, either at
+the recorded speed or as fast as it will go.
+
+    python smash.py --record session.replay
+    python replay.py session.replay --hidden --profile profile.json
+'''
+
+import argparse
+import os
+import random
+import struct
+
+import pygame
+
+import frames
+import graphics
+import headless
+import profiling
+import ui
+import vectorized
+
+MAGIC = 'OSRP'
+VERSION = 2
+
+# Magic, version, seed and mode flags.
+HEADER = struct.Struct('<4sBIB')
+# Milliseconds the frame took, mouse x and y, and button flags.
+FRAME = struct.Struct('<HhhB')
+
+PRESSED = 1
+RELEASED = 2
+
+# Mode flags.
+VECTORIZED = 1
+
+
+class ReplayError(Exception): pass
+
+class ReplayFinished(Exception): pass
+
+
+class Recorder(object):
+    '''
+    Seeds the global random generator and logs frames to `path`. Input is
+    held until the frame's time is known, then written out as one record.
+    Whether games use the numpy store has to be settled beforehand.
+    '''
+    def __init__(self, path, seed=None):
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        random.seed(seed)
+        mode = VECTORIZED if vectorized.make_store() is not None else 0
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, seed, mode))
+        self.mouse = (0, 0)
+        self.flags = 0
+
+    def input(self, mouse, pressed, released):
+        self.mouse = mouse
+        self.flags = (PRESSED if pressed else 0) | (RELEASED if released else 0)
+
+    def frame(self, milliseconds):
+        x, y = self.mouse
+        self.file.write(FRAME.pack(min(int(milliseconds), 0xffff), x, y, self.flags))
+
+    def close(self):
+        self.file.close()
+
+
+class RecordingClock(frames.Clock):
+    def __init__(self, recorder):
+        frames.Clock.__init__(self)
+        self.recorder = recorder
+
+    def tick(self, fps):
+        milliseconds = frames.Clock.tick(self, fps)
+        self.recorder.frame(milliseconds)
+        return milliseconds
+
+
+class RecordingEvents(ui.Events):
+    def __init__(self, recorder):
+        ui.Events.__init__(self)
+        self.recorder = recorder
+
+    def control(self, things, mouse, pressed, released):
+        self.recorder.input(mouse, pressed, released)
+        ui.Events.control(self, things, mouse, pressed, released)
+
+
+def load(path):
+    '''
+    Returns the seed, the mode flags and the list of frame records. A
+    partly written last record, as left by a crash, is dropped.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ReplayError('{0} is not a replay'.format(path))
+    magic, version = data[:len(MAGIC)], ord(data[len(MAGIC)])
+    if magic != MAGIC:
+        raise ReplayError('{0} is not a replay'.format(path))
+    if version != VERSION:
+        raise ReplayError('{0} is replay version {1}, expected {2}'.format(path, version, VERSION))
+    magic, version, seed, mode = HEADER.unpack_from(data)
+    count = (len(data) - HEADER.size) // FRAME.size
+    log = [FRAME.unpack_from(data, HEADER.size + i * FRAME.size) for i in xrange(count)]
+    return seed, mode, log
+
+
+class Playback(object):
+    def __init__(self, log):
+        self.log = log
+        self.index = 0
+
+    def current(self):
+        if self.index >= len(self.log):
+            raise ReplayFinished()
+        return self.log[self.index]
+
+    def advance(self):
+        milliseconds = self.current()[0]
+        self.index += 1
+        return milliseconds
+
+
+class ReplayClock(frames.Clock):
+    '''
+    Reports the recorded frame times. Unless `realtime` is set it never
+    waits, so playback runs as fast as the game can simulate and draw.
+    '''
+    def __init__(self, playback, realtime=False):
+        frames.Clock.__init__(self)
+        self.playback = playback
+        self.realtime = realtime
+
+    def tick(self, fps):
+        milliseconds = self.playback.advance()
+        if self.realtime:
+            self.clock.tick(1000.0 / max(milliseconds, 1))
+        return milliseconds
+
+    def restart(self):
+        pass
+
+
+class ReplayEvents(headless.ScriptedEvents):
+    def __init__(self, playback):
+        self.playback = playback
+
+    def process(self, things):
+        if pygame.display.get_init():
+            for event in pygame.event.get(pygame.QUIT):
+                raise SystemExit(0)
+        milliseconds, x, y, flags = self.playback.current()
+        self.control(things, (x, y), bool(flags & PRESSED), bool(flags & RELEASED))
+
+
+def play(path, renderer, realtime=False):
+    '''
+    Plays the log at `path` from the first wave until it runs out, and
+    returns the number of frames played.
+
+    `renderer` should be a graphics.Renderer, even a hidden one: the game
+    waits for explosions to finish before it ends a wave, so a renderer
+    that doesn't animate would end waves at different frames. Physics
+    runs with or without the numpy store, as it did when recording.
+    '''
+    seed, mode, log = load(path)
+    if mode & VECTORIZED and vectorized.numpy is None:
+        raise ReplayError('{0} was recorded with numpy, which is not installed'.format(path))
+    vectorized.enabled = bool(mode & VECTORIZED)
+    random.seed(seed)
+    playback = Playback(log)
+    timer = ReplayClock(playback, realtime)
+    events = ReplayEvents(playback)
+
+    stack = [frames.Gameloop(renderer, [], 0, timer, events)]
+    try:
+        while True:
+            top = stack[-1]
+            try:
+                if isinstance(top, frames.Dialog):
+                    top.next()
+                    stack.pop()
+                elif isinstance(top, frames.Menu):
+                    # Pausing isn't recorded, so this is the game over menu.
+                    # If the log goes on, the player chose to play again.
+                    playback.current()
+                    stack.append(top.funcs[top.options[0]]())
+                else:
+                    next = top.loop()
+                    if next is not None:
+                        stack.append(next)
+            except frames.EndFrame:
+                stack.pop()
+            except frames.EndFramePushNext as ex:
+                stack.pop()
+                stack.append(ex.next)
+    except ReplayFinished:
+        pass
+    return playback.index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play back an Orbital Smash replay')
+    parser.add_argument('path')
+    parser.add_argument('--realtime', action='store_true',
+                        help='play at the recorded speed instead of as fast as possible')
+    parser.add_argument('--hidden', action='store_true',
+                        help="don't open a window (uses a dummy video driver)")
+    parser.add_argument('--profile', default=None,
+                        help='profile every frame and write the results here')
+    args = parser.parse_args()
+
+    if args.hidden:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    renderer = graphics.Renderer()
+    if args.profile is not None:
+        renderer.profiler = profiling.FrameProfiler(size=None)
+        renderer.profiler.toggle()
+    count = play(args.path, renderer, args.realtime)
+    print 'Played {0} frames'.format(count)
+    if args.profile is not None:
+        renderer.profiler.dump(args.profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+'''
+Saves a wave in progress to disk and loads it back.
+
+A save is a fixed header, the component names, then the snapshot records
+of the world and of the wave's queue exactly as snapshot.take lays them
+out in memory, then the collector links. Saving is a single write, and
+loading maps the file and copies each block into an array in one go
+rather than parsing it field by field.
+'''
+
+import array
+import mmap
+import struct
+import sys
+
+import entities
+import physics
+import snapshot
+
+MAGIC = 'OSSV'
+VERSION = 1
+
+# Magic, version, whether the blocks are big-endian, record size in
+# doubles, world and queue entity counts, world and queue link counts,
+# size of the component name table, the wave's max score and the
+# simulation time.
+HEADER = struct.Struct('<4sHBxIIIIIIdd')
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class SaveError(Exception): pass
+
+
+class SaveState(object):
+    '''
+    A loaded save: snapshots of the world and the queue, holding freshly
+    built entities. `apply` puts the saved numbers back once the game has
+    initialized those entities.
+    '''
+    def __init__(self, world, queue, max_score):
+        self.world = world
+        self.queue = queue
+        self.max_score = max_score
+
+    def apply(self, world, clock=None):
+        snapshot.restore(world, self.world, clock)
+        snapshot.write(self.queue)
+
+
+def pad(block):
+    return block + '\0' * (-len(block) % 8)
+
+
+def save(path, world, queue, max_score, clock):
+    '''Saves the live `world`, the entities still `queue`d to join it and the clock.'''
+    things = snapshot.take(world, clock)
+    waiting = snapshot.take(queue)
+
+    names = sorted(entities.component_bits, key=entities.component_bits.get)
+    table = pad('\n'.join(names))
+    header = HEADER.pack(
+        MAGIC, VERSION, BIG_ENDIAN, snapshot.STRIDE,
+        len(things), len(waiting), len(things.links) / 2, len(waiting.links) / 2,
+        len(table), max_score, things.time)
+    with open(path, 'wb') as f:
+        f.write(''.join([
+            header,
+            table,
+            things.data.tostring(),
+            waiting.data.tostring(),
+            pad(things.links.tostring() + waiting.links.tostring())]))
+
+
+def read_block(mapped, offset, typecode, count, swap):
+    block = array.array(typecode)
+    block.fromstring(mapped[offset:offset + count * block.itemsize])
+    if swap:
+        block.byteswap()
+    return block, offset + count * block.itemsize
+
+
+def build(data, count, names):
+    '''
+    Makes an entity for each record, and rewrites the record's component
+    mask in terms of this process's component bits. Entities are aimed
+    where they were, since bullets take their start from that.
+    '''
+    things = []
+    for i in xrange(count):
+        base = i * snapshot.STRIDE
+        mask = int(data[base])
+        e = entities.Entity(*[name for bit, name in enumerate(names) if mask >> bit & 1])
+        data[base] = e.mask
+        k = base + snapshot.HEADER
+        e.initial_position = physics.Cartesian(data[k], data[k + 1])
+        e.initial_velocity = physics.Cartesian(data[k + 2], data[k + 3])
+        things.append(e)
+    return things
+
+
+def load(path):
+    '''Reads a save written by `save` into a SaveState.'''
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(mapped) < HEADER.size or mapped[:len(MAGIC)] != MAGIC:
+            raise SaveError('{0} is not a save'.format(path))
+        (magic, version, big_endian, stride, thing_count, queue_count,
+            thing_links, queue_links, table_size, max_score, time) = HEADER.unpack_from(mapped)
+        if version != VERSION or stride != snapshot.STRIDE:
+            raise SaveError('{0} is save version {1}, expected {2}'.format(path, version, VERSION))
+
+        offset = HEADER.size
+        names = mapped[offset:offset + table_size].rstrip('\0').split('\n')
+        offset += table_size
+        swap = big_endian != BIG_ENDIAN
+        data, offset = read_block(mapped, offset, 'd', (thing_count + queue_count) * stride, swap)
+        links, offset = read_block(mapped, offset, 'i', 2 * (thing_links + queue_links), swap)
+    finally:
+        mapped.close()
+
+    split = thing_count * stride
+    world = data[:split]
+    waiting = data[split:]
+    return SaveState(
+        snapshot.Snapshot(build(world, thing_count, names), world, links[:2 * thing_links], time),
+        snapshot.Snapshot(build(waiting, queue_count, names), waiting, links[2 * thing_links:], None),
+        max_score)
@@ -1,17 +1,46 @@
 #!/usr/bin/env python
 
+import argparse
 import errors
 import traceback
 import frames
+import graphics
+import replay
+import vectorized
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Orbital Smash')
+    parser.add_argument('--record', default=None, metavar='PATH',
+                        help='record the session so replay.py can play it back')
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help='only redraw the parts of the screen that change')
+    parser.add_argument('--rotation-steps', type=int, default=180, metavar='N',
+                        help='how many angles sprites are drawn at (default: 180)')
+    parser.add_argument('--vectorize', action='store_true',
+                        help='move entities with the numpy kinematics store')
+    args = parser.parse_args()
+    vectorized.enabled = args.vectorize
+    
+    recorder = None
     try:
-        frames.mainloop()
+        renderer = graphics.Renderer(
+            prebake=True, dirty_rects=args.dirty_rects, rotation_steps=args.rotation_steps)
+        if args.record is None:
+            frames.mainloop(renderer=renderer)
+        else:
+            # A replay always starts from a new game, so a recording can't
+            # begin with a saved wave.
+            recorder = replay.Recorder(args.record)
+            frames.mainloop(
+                replay.RecordingClock(recorder), replay.RecordingEvents(recorder), renderer, resumable=False)
     except Exception as err:
         error = traceback.format_exc()
         errors.log('Top-level exception: ' + error)
         errors.error('The program encountered an unexpected error.\n\n' + 
             'Please see "log.txt" for details, and send an email to ' +
             '"michael.lee.0x2a@gmail.com" for help.')
+    finally:
+        if recorder is not None:
+            recorder.close()
 
     
\ No newline at end of file
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+'''
+Cheap copies of a world's simulation state, for rollback, checkpoints and
+trying out "what if" without touching the live game.
+
+A snapshot keeps the entity objects themselves plus a flat array of their
+numbers, one fixed-size record per entity. Sprites, fonts and anything
+else that the simulation does not change are never copied; restoring
+writes the numbers back into the same objects.
+'''
+
+import array
+import itertools
+import operator
+
+import entities
+import physics
+import vectorized
+
+VECTORS = ('position', 'velocity', 'acceleration')
+
+SCALARS = (
+    'health',
+    'max_health',
+    'mass',
+    'dampening',
+    'radius',
+    'angle',
+    'speed',
+    'additional_damage',
+    'last_movement_time',
+    'move_timer_delta',
+    'last_shoot_time',
+    'shoot_timer_delta',
+    'draw_radius',
+    'push_radius',
+    'max_collectable',
+    'is_collector_active',
+)
+
+# Every record is the component mask, a bitmask of which of the fields
+# below the entity has (vectors first), then the vectors and the scalars.
+# Fields the entity doesn't have are left as 0.
+HEADER = 2
+STRIDE = HEADER + 2 * len(VECTORS) + len(SCALARS)
+
+# Masks are stored as doubles, which hold integers exactly up to 2**53.
+MAX_COMPONENTS = 53
+
+FIELDS = VECTORS + SCALARS
+
+# Defaults for the fields an entity doesn't have.
+ORIGINS = (physics.Cartesian(0, 0),) * len(VECTORS)
+ZEROS = (0,) * len(SCALARS)
+
+
+class Snapshot(object):
+    def __init__(self, things, data, links, time):
+        self.things = things
+        self.data = data
+        self.links = links
+        self.time = time
+
+    def __len__(self):
+        return len(self.things)
+
+
+presences = {}
+
+def get_present(flags):
+    '''Turns a tuple of which FIELDS an entity has into a bitmask.'''
+    present = presences.get(flags)
+    if present is None:
+        present = presences[flags] = sum(1 << i for i, flag in enumerate(flags) if flag)
+    return present
+
+
+def take(world, clock=None):
+    '''
+    Records every entity in `world`, and the simulation time if `clock` is
+    given.
+    '''
+    if len(entities.component_bits) > MAX_COMPONENTS:
+        raise ValueError('too many components to snapshot')
+
+    things = list(world)
+    data = array.array('d')
+    positions = {}
+    for i, e in enumerate(things):
+        positions[e] = i
+        attributes = e.__dict__
+        present = get_present(tuple(map(attributes.__contains__, FIELDS)))
+        p, v, a = map(attributes.get, VECTORS, ORIGINS)
+        data.extend((e.mask, present, p.x, p.y, v.x, v.y, a.x, a.y))
+        data.extend(map(attributes.get, SCALARS, ZEROS))
+
+    # Collector links are kept as (collector, held) pairs of record numbers,
+    # since handles go stale whenever the world is rebuilt.
+    links = array.array('i')
+    for e in entities.query(things, entities.Collector):
+        for handle in getattr(e, 'collected_objects', ()):
+            other = entities.resolve(handle)
+            if other is not None and other in positions:
+                links.extend((positions[e], positions[other]))
+
+    time = clock.get_ticks() if clock is not None else None
+    return Snapshot(things, data, links, time)
+
+
+def set_mask(e, mask):
+    for component, bit in entities.component_bits.items():
+        if mask & bit:
+            e.add(component)
+        else:
+            e.remove(component)
+
+
+layouts = {}
+
+def get_layout(present):
+    '''
+    For a presence bitmask: the vectors the entity has (None if it has all
+    of them) with their offsets in the record, the scalars it has, a
+    function that picks those out of a record, and the scalars it doesn't
+    have.
+    '''
+    layout = layouts.get(present)
+    if layout is None:
+        vectors = [(name, HEADER + 2 * i) for i, name in enumerate(VECTORS)
+                   if present & (1 << i)]
+        if len(vectors) == len(VECTORS):
+            vectors = None
+        found = [i for i in xrange(len(SCALARS)) if present & (1 << (len(VECTORS) + i))]
+        names = tuple(SCALARS[i] for i in found)
+        offset = HEADER + 2 * len(VECTORS)
+        pick = operator.itemgetter(*[offset + i for i in found]) if len(found) > 1 else None
+        if len(found) == 1:
+            single = offset + found[0]
+            pick = lambda record: (record[single],)
+        missing = frozenset(SCALARS) - frozenset(names)
+        layout = layouts[present] = (vectors, names, pick, missing)
+    return layout
+
+
+def write(snapshot):
+    '''
+    Writes the recorded numbers and collector links back into the
+    snapshot's entities, wherever they are. Vectors that are rows of a
+    vectorized.KinematicsStore are written into its arrays in one go at the
+    end rather than a number at a time through the Row views.
+    '''
+    things = snapshot.things
+    data = snapshot.data
+    rows = []
+    kinematics = array.array('d')
+    stored = None
+    base = 0
+    for e in things:
+        record = data[base:base + STRIDE]
+        base += STRIDE
+        if record[0] != e.mask:
+            set_mask(e, int(record[0]))
+        vectors, names, pick, missing = layouts.get(record[1]) or get_layout(int(record[1]))
+        attributes = e.__dict__
+        try:
+            if vectors is None:
+                p, v, a = attributes['position'], attributes['velocity'], attributes['acceleration']
+                if type(p) is vectorized.Row:
+                    stored = p.array, v.array, a.array
+                    rows.append(p.index)
+                    kinematics.extend(record[HEADER:HEADER + 6])
+                else:
+                    p.x, p.y, v.x, v.y, a.x, a.y = record[HEADER:HEADER + 6]
+                vectors = ()
+        except KeyError:
+            vectors = [(name, HEADER + 2 * i) for i, name in enumerate(VECTORS)]
+        for name, k in vectors:
+            attributes[name] = physics.Cartesian(record[k], record[k + 1])
+        if pick is not None:
+            attributes.update(itertools.izip(names, pick(record)))
+        if not missing.isdisjoint(attributes):
+            for name in missing:
+                attributes.pop(name, None)
+    if rows:
+        kinematics = vectorized.numpy.frombuffer(kinematics).reshape(-1, 6)
+        for i, column in enumerate(stored):
+            column[rows] = kinematics[:, 2 * i:2 * i + 2]
+
+    for e in entities.query(things, entities.Collector):
+        e.collected_objects = []
+    links = snapshot.links
+    for i in xrange(0, len(links), 2):
+        things[links[i]].collected_objects.append(things[links[i + 1]].handle())
+
+
+def restore(world, snapshot, clock=None):
+    '''
+    Puts `world` back the way it was when `snapshot` was taken. Entities
+    spawned since then are removed (and handed back to their pools);
+    entities that have despawned since then come back. The AI's timers
+    need rebuilding afterwards with AI.reschedule.
+
+    This is not yet well under a millisecond for a few hundred entities:
+    for 300 enemies it takes about 0.9 ms, plus about 0.35 ms for
+    AI.reschedule. Most of that is the per-entity attribute writes.
+    '''
+    things = snapshot.things
+    if world.things != things:
+        kept = set(things)
+        for e in list(world):
+            world.remove(e)
+            if e not in kept and hasattr(e, 'pool'):
+                e.pool.release(e)
+        for e in things:
+            if hasattr(e, 'pool'):
+                e.pool.reclaim(e)
+            world.append(e)
+
+    write(snapshot)
+
+    # Anything queued for despawn after the snapshot was taken is alive again.
+    world.pending = list(world.query(entities.Dead))
+
+    if clock is not None and snapshot.time is not None:
+        clock.time = snapshot.time
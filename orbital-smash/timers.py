@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+
+
+class TimerQueue(object):
+    '''
+    Entity timers in simulation time, kept in a heap so that each step
+    only looks at the timers that have come due rather than at every
+    entity that has one.
+
+    Timers belong to one life of an entity: once it leaves its world
+    (which bumps its generation) they are dropped. Timers of entities that
+    haven't joined a world yet stay due until they do.
+    '''
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def clear(self):
+        self.heap = []
+
+    def add(self, deadline, e, kind):
+        heapq.heappush(self.heap, (deadline, next(self.counter), e, e.generation, kind))
+        
+    def fill(self, timers):
+        '''
+        Replaces every timer with `timers`, given as (deadline, entity,
+        kind), in one heapify rather than a push each.
+        '''
+        counter = self.counter
+        self.heap = [(deadline, next(counter), e, e.generation, kind) for deadline, e, kind in timers]
+        heapq.heapify(self.heap)
+
+    def next_deadline(self):
+        '''When the next timer is due, or None if there are none.'''
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def pop_due(self, now):
+        '''
+        Removes the timers due by `now` and returns their (deadline,
+        entity, kind), sorted by deadline and then by the entities' order
+        in their world. That order doesn't depend on when the timers were
+        added, so rebuilding the queue doesn't change what happens.
+        '''
+        heap = self.heap
+        due = []
+        waiting = []
+        while len(heap) > 0 and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            deadline, count, e, generation, kind = entry
+            if e.generation != generation:
+                continue
+            if e.world is None:
+                waiting.append(entry)
+            else:
+                due.append((deadline, e.world_index, kind, e))
+        for entry in waiting:
+            heapq.heappush(heap, entry)
+        due.sort(key=lambda item: item[:3])
+        return [(deadline, e, kind) for deadline, index, kind, e in due]
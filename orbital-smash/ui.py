@@ -25,24 +25,28 @@ class Events(object):
         if event.type == pygame.KEYDOWN:
             if event.key in [pygame.K_ESCAPE, pygame.K_p]:
                 frame = frames.make_pause_menu
+            if event.key == pygame.K_F3:
+                frame = frames.toggle_profiler
         #if not pygame.mouse.get_focused():
         #    frame = frames.make_pause_menu
         
-            
-        for e in things:
-            if entities.UserControllable in e:
-                target = physics.Cartesian(*pygame.mouse.get_pos())
-                force = 20
-                acceleration = (target - e.position).to_polar()
-                acceleration.magnitude = force / e.mass
-                e.acceleration = acceleration.to_cartesian()
-                if entities.Collector in e:
-                    if event.type == pygame.MOUSEBUTTONDOWN:
-                        e.is_collector_active = True
-                    if event.type == pygame.MOUSEBUTTONUP:
-                        e.is_collector_active = False
-                        e.collected_objects = []
+        self.control(
+            things, 
+            pygame.mouse.get_pos(), 
+            event.type == pygame.MOUSEBUTTONDOWN, 
+            event.type == pygame.MOUSEBUTTONUP)
                 
         return frame
+        
+    def control(self, things, mouse, pressed, released):
+        for e in entities.query(things, entities.UserControllable):
+            target = physics.Cartesian(*mouse)
+            force = 20
+            e.acceleration = (target - e.position).normalize().imul(force / e.mass)
+            if entities.Collector in e:
+                if pressed:
+                    e.is_collector_active = True
+                if released:
+                    e.is_collector_active = False
+                    e.collected_objects = []
                 
-        
\ No newline at end of file
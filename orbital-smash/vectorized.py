@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import physics
+
+
+# Whether games use a KinematicsStore. Off unless asked for: the collision
+# and orbit code still reads positions one entity at a time, through Row
+# views, which costs more than integrating in one pass saves.
+enabled = False
+
+
+def make_store(capacity=64):
+    '''
+    Returns a KinematicsStore, or None when the store isn't `enabled` or
+    numpy is not installed so the physics engine integrates entities one
+    at a time.
+    '''
+    if numpy is None or not enabled:
+        return None
+    return KinematicsStore(capacity)
+
+
+class Row(physics.Cartesian):
+    '''
+    A Cartesian view onto one row of a store array. Reads and writes go
+    straight to the array, so the rest of the game can keep using
+    `e.position.x` and friends.
+    '''
+    __slots__ = ('array', 'index')
+    
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    def get_x(self):
+        return float(self.array[self.index, 0])
+
+    def set_x(self, value):
+        self.array[self.index, 0] = value
+
+    def get_y(self):
+        return float(self.array[self.index, 1])
+
+    def set_y(self, value):
+        self.array[self.index, 1] = value
+
+    x = property(get_x, set_x)
+    y = property(get_y, set_y)
+
+
+class KinematicsStore(object):
+    '''
+    Structure-of-arrays storage for the position, velocity and acceleration
+    of every Moveable entity, indexed by `e.row`.
+
+    Code elsewhere is free to rebind `e.position = ...`; the next call to
+    `integrate` notices the binding is no longer the store's view, copies
+    the new value in, and puts the view back.
+    '''
+    fields = ('position', 'velocity', 'acceleration')
+
+    def __init__(self, capacity=64, max_speed=15):
+        self.capacity = 0
+        self.max_speed = max_speed
+        self.position = numpy.zeros((0, 2))
+        self.velocity = numpy.zeros((0, 2))
+        self.acceleration = numpy.zeros((0, 2))
+        self.dampening = numpy.ones(0)
+        self.active = numpy.zeros(0, dtype=bool)
+        self.entities = []
+        self.free = []
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        old = self.capacity
+        for field in self.fields:
+            array = numpy.zeros((capacity, 2))
+            array[:old] = getattr(self, field)
+            setattr(self, field, array)
+        dampening = numpy.ones(capacity)
+        dampening[:old] = self.dampening
+        self.dampening = dampening
+        active = numpy.zeros(capacity, dtype=bool)
+        active[:old] = self.active
+        self.active = active
+
+        self.entities.extend([None] * (capacity - old))
+        self.free.extend(range(capacity - 1, old - 1, -1))
+        self.capacity = capacity
+
+        # Views hold on to the array they were made from.
+        for e in self.entities:
+            if e is not None:
+                for field in self.fields:
+                    value = getattr(e, field)
+                    if isinstance(value, Row):
+                        value.array = getattr(self, field)
+
+    def attach(self, e):
+        if len(self.free) == 0:
+            self.grow(self.capacity * 2)
+        slot = self.free.pop()
+        self.entities[slot] = e
+        e.row = slot
+        for field in self.fields:
+            value = getattr(e, field)
+            array = getattr(self, field)
+            array[slot] = (value.x, value.y)
+            setattr(e, field, Row(array, slot))
+        return slot
+
+    def detach(self, slot):
+        e = self.entities[slot]
+        for field in self.fields:
+            value = getattr(e, field)
+            setattr(e, field, physics.Cartesian(value.x, value.y))
+        del e.row
+        self.entities[slot] = None
+        self.active[slot] = False
+        self.free.append(slot)
+
+    def sync(self, e):
+        slot = getattr(e, 'row', None)
+        if slot is None or self.entities[slot] is not e:
+            return self.attach(e)
+        for field in self.fields:
+            value = getattr(e, field)
+            if not isinstance(value, Row):
+                array = getattr(self, field)
+                array[slot] = (value.x, value.y)
+                setattr(e, field, Row(array, slot))
+        return slot
+
+    def integrate(self, things):
+        '''
+        Runs one integration step for `things`, the Moveable entities that
+        are still alive. Rows belonging to anything else are released.
+        '''
+        slots = []
+        for e in things:
+            slot = self.sync(e)
+            self.dampening[slot] = e.dampening
+            slots.append(slot)
+        seen = numpy.zeros(self.capacity, dtype=bool)
+        seen[slots] = True
+        for slot in numpy.flatnonzero(self.active & ~seen):
+            self.detach(slot)
+        self.active[:] = seen
+
+        velocity = self.velocity[seen] + self.acceleration[seen]
+        velocity *= self.dampening[seen, None]
+
+        speed = numpy.hypot(velocity[:, 0], velocity[:, 1])
+        fast = speed >= self.max_speed
+        velocity[fast] *= (self.max_speed / speed[fast])[:, None]
+
+        self.velocity[seen] = velocity
+        self.position[seen] += velocity
+
+
+# These do the same operations in the same order as the Cartesian methods
+# they stand in for, so that each row comes out bit-for-bit the same.
+
+def lengths(vectors):
+    return numpy.sqrt(vectors[:, 0] * vectors[:, 0] + vectors[:, 1] * vectors[:, 1])
+
+
+def unit(vectors):
+    '''Cartesian.normalize for each row, so zero rows become (1, 0).'''
+    length = lengths(vectors)
+    out = numpy.zeros_like(vectors)
+    out[:, 0] = 1
+    nonzero = length != 0
+    out[nonzero] = vectors[nonzero] / length[nonzero, None]
+    return out
+
+
+def sphere_collision(pos_a, pos_b, vel_a, vel_b, rad_b, mass_a, mass_b):
+    point = pos_b + unit(pos_a - pos_b) * rad_b[:, None]
+    normal = unit(pos_a - point)
+    dot = (normal * vel_a).sum(axis=1)
+    reflection = vel_a - 2 * dot[:, None] * normal
+
+    total = mass_a + mass_b
+    momentum = mass_a * lengths(vel_a) + mass_b * lengths(vel_b)
+    magnitude = momentum / numpy.where(total == 0, 1, total)
+    out = unit(reflection) * magnitude[:, None]
+
+    still = (mass_a == 0) | (mass_b == 0)
+    out[still] = vel_a[still]
+    return out
+
+
+def narrowphase(position, velocity, radius, mass, bonus, first, second, step):
+    '''
+    Batched equivalent of the per-pair work in Physics.process: is_colliding,
+    then fix_overlap, calculate_sphere_collision for both bodies (the second
+    one seeing the first one's new velocity, as in calculate_collision) and
+    calculate_damage.
+
+    `position` and `velocity` are (n, 2) arrays, `radius`, `mass` and `bonus`
+    (additional_damage for ContactAttack entities, otherwise 0) are length n,
+    and `first`/`second` index the candidate pairs. Each pair is evaluated
+    against the input state only, so a body that appears in several pairs
+    gets one independent answer per pair; callers decide how to merge them.
+
+    Returns (hit, position_a, position_b, velocity_a, velocity_b, damage_a,
+    damage_b), one row per pair. Rows that do not collide carry the input
+    position and velocity and zero damage. For colliding rows the results
+    agree with the scalar functions to within 1e-6, including bodies on
+    the same point. Since every step is done in the same order as the
+    scalar code they come out bit-for-bit the same in practice, which
+    matters for deep overlaps: there hard_push leaves both bodies almost on
+    one point, and the bounce direction comes from the last bits of their
+    positions.
+    '''
+    pos_a = position[first]
+    pos_b = position[second]
+    vel_a = velocity[first]
+    vel_b = velocity[second]
+    rad_a = radius[first]
+    rad_b = radius[second]
+    mass_a = mass[first]
+    mass_b = mass[second]
+
+    delta = pos_a - pos_b
+    distance = lengths(delta)
+    hit = distance <= rad_a + rad_b + 1
+
+    # hard_push
+    point = pos_b + unit(delta) * rad_b[:, None]
+    new_pos_a = point + unit(pos_a - point) * (rad_a + 1)[:, None]
+    new_pos_b = point + unit(pos_b - point) * (rad_b + 1)[:, None]
+
+    new_vel_a = sphere_collision(
+        new_pos_a, new_pos_b, vel_a, vel_b, rad_b, mass_a, mass_b)
+    new_vel_b = sphere_collision(
+        new_pos_b, new_pos_a, vel_b, new_vel_a, rad_a, mass_b, mass_a)
+
+    # calculate_individual_damage uses the post-collision velocities.
+    damage_a = mass_b * (lengths(new_vel_b) * step) + 1 + bonus[second]
+    damage_b = mass_a * (lengths(new_vel_a) * step) + 1 + bonus[first]
+
+    miss = ~hit
+    new_pos_a[miss] = pos_a[miss]
+    new_pos_b[miss] = pos_b[miss]
+    new_vel_a[miss] = vel_a[miss]
+    new_vel_b[miss] = vel_b[miss]
+    damage_a[miss] = 0
+    damage_b[miss] = 0
+
+    return hit, new_pos_a, new_pos_b, new_vel_a, new_vel_b, damage_a, damage_b
+
+
+# Steering is done with the same operations in the same order as the
+# Cartesian methods it replaces, so that with a store, batched steering
+# gives bit-for-bit the numbers AI.track and AI.circle would. A game with
+# a store doesn't play out like one without: the store integrates every
+# body after all contacts are resolved and clamps speed its own way.
+
+def gather(store, group):
+    '''Store rows for `group`, attaching any entity that doesn't have one yet.'''
+    return numpy.array([store.sync(e) for e in group], dtype=int)
+
+
+def locate(targets):
+    '''Positions of `targets`, reading each distinct entity only once.'''
+    found = {}
+    for t in targets:
+        if t not in found:
+            found[t] = (t.position.x, t.position.y)
+    return numpy.array([found[t] for t in targets])
+
+
+def seek(store, group, targets, field=None):
+    '''
+    Batched TrackingPath steering: every entity in `group` heads for the
+    matching entry of `targets` at its own speed, straight there unless
+    the pathing.FlowField `field` has a way round something in between.
+    '''
+    rows = gather(store, group)
+    position = store.position[rows]
+    direction = unit(locate(targets) - position)
+    if field is not None and field.detours > 0:
+        last = field.columns - 1
+        cells = numpy.clip(position // field.cell_size, 0, last).astype(int)
+        flow = field.flow
+        for i, cell in enumerate((cells[:, 1] * field.columns + cells[:, 0]).tolist()):
+            if flow[cell] is not None:
+                direction[i] = flow[cell]
+    speed = numpy.array([e.speed for e in group], dtype=float)
+    store.velocity[rows] = direction * speed[:, None]
+
+
+def orbit(store, group, humans, signs, scale):
+    '''
+    Batched CirclePath steering. Each entity in `group` is pulled back
+    within range of the matching entry of `humans` if it has strayed too
+    far or come too close, then pushed a quarter turn either way (`signs`)
+    around it, `scale` times as hard as a single step's worth.
+    '''
+    rows = gather(store, group)
+    position = store.position[rows]
+    center = locate(humans)
+    draw_radius = numpy.array([h.draw_radius for h in humans], dtype=float)
+    push_radius = numpy.array([h.push_radius for h in humans], dtype=float)
+    pull = numpy.array([sign * e.mass * h.mass for e, h, sign in zip(group, humans, signs)],
+                       dtype=float)
+
+    distance = lengths(position - center)
+    normal = unit(center - position)
+
+    far = distance > draw_radius + 200
+    position[far] = center[far] - normal[far] * (draw_radius[far] + 175)[:, None]
+    near = distance < draw_radius + 150
+    position[near] = center[near] - normal[near] * (push_radius[near] + 175)[:, None]
+    store.position[rows] = position
+
+    tangent = numpy.column_stack((-normal[:, 1], normal[:, 0]))
+    # numpy squares with a multiply when the exponent is a plain number,
+    # which isn't always what Python's ** gives; an array exponent makes it
+    # call pow() like Python does.
+    squared = numpy.power(distance, numpy.full_like(distance, 2))
+    store.velocity[rows] += tangent * (pull / squared * scale)[:, None]